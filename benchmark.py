@@ -0,0 +1,145 @@
+import argparse, hashlib, time, json, os, datetime, random, gc, tracemalloc, base58
+from pow_utils import ProofEngine, is_valid_proof, bits_to_target
+from chain_utils import Block
+import codec_utils
+
+sha = lambda x: hashlib.sha256(x if isinstance(x,bytes) else x.encode()).digest()
+
+def legacy_is_valid_proof(last_proof, last_hash, proof):
+    # Proof check as it was done before pow_utils (full string, hex compare)
+    guess = f'{last_proof}{last_hash}{proof}'.encode()
+    guess_hash = sha(guess).hex()
+    n = 6
+    return guess_hash[:n] == "0"*n
+
+def bench_pow(args):
+    last_proof, last_hash = 9, hashlib.sha256(b"benchmark").hexdigest()
+    n = args.nonces
+
+    # Both rules must agree on every nonce, check it with an easy difficulty too
+    engine = ProofEngine(last_proof, last_hash, bits_to_target(8))
+    for proof in range(20000):
+        hx = sha(f'{last_proof}{last_hash}{proof}').hex()
+        assert engine.is_valid(proof) == (hx[:2] == "00") == is_valid_proof(last_proof, last_hash, proof, bits_to_target(8))
+        assert is_valid_proof(last_proof, last_hash, proof) == legacy_is_valid_proof(last_proof, last_hash, proof)
+
+    st = time.time()
+    for proof in range(n):
+        legacy_is_valid_proof(last_proof, last_hash, proof)
+    legacy = n/(time.time()-st)
+
+    engine = ProofEngine(last_proof, last_hash)
+    st = time.time()
+    engine.search(0, n)
+    fast = n/(time.time()-st)
+
+    print("Nonces tested: {}".format(n))
+    print("Before (is_valid_proof loop): {:,.0f} H/s".format(legacy))
+    print("After (ProofEngine.search):   {:,.0f} H/s".format(fast))
+    print("Speedup: {:.2f}x".format(fast/legacy))
+
+def sample_wallet():
+    # (address, public key), the address has the same format but isn't derived from the key
+    payload = b"\x00"+os.urandom(20)
+    return base58.b58encode(payload+sha(sha(payload))[:4]).decode(), os.urandom(64).hex()
+
+def sample_block(n, tokens, wallets):
+    # Block with the same fields and sizes as the real ones, random signatures
+    txs = []
+    for _ in range(tokens):
+        sender, public = random.choice(wallets)
+        t = {
+            'sender': sender,
+            'recipient': random.choice(wallets)[0],
+            'amount': 1.5,
+            'timestamp': datetime.datetime.now().isoformat(),
+            'public_key': public,
+        }
+        t['hash'] = sha(json.dumps(t, sort_keys=True)).hex()
+        t['signature'] = os.urandom(64).hex()
+        txs.append(t)
+    block = {
+        'block_n': n,
+        'timestamp': datetime.datetime.now().isoformat(),
+        'token_n': len(txs),
+        'tokens': txs,
+        'miner': random.choice(wallets)[0],
+        'previous_hash': os.urandom(32).hex(),
+        'pow': 123456,
+    }
+    block['hash'] = sha(json.dumps(block, sort_keys=True)).hex()
+    return block
+
+def timed(f, items, rounds):
+    st = time.time()
+    for _ in range(rounds):
+        for x in items:
+            f(x)
+    return (time.time()-st)/(rounds*len(items))
+
+def bench_codec(args):
+    wallets = [sample_wallet() for _ in range(args.wallets)]
+    blocks = [sample_block(n, args.tokens, wallets) for n in range(args.blocks)]
+    for b in blocks:
+        assert codec_utils.decode(codec_utils.encode(b)) == b
+
+    dumps = lambda b: json.dumps(b, sort_keys=True).encode()
+    js = [dumps(b) for b in blocks]
+    bs = [codec_utils.encode(b) for b in blocks]
+    js_size, bs_size = sum(map(len, js)), sum(map(len, bs))
+
+    print("Blocks: {}, tokens per block: {}, wallets: {}".format(args.blocks, args.tokens, args.wallets))
+    print("Size json:   {:,} bytes".format(js_size))
+    print("Size binary: {:,} bytes ({:.0%} of json)".format(bs_size, bs_size/js_size))
+    print("Encode json:   {:.3f} ms/block".format(timed(dumps, blocks, args.rounds)*1000))
+    print("Encode binary: {:.3f} ms/block".format(timed(codec_utils.encode, blocks, args.rounds)*1000))
+    print("Decode json:   {:.3f} ms/block".format(timed(json.loads, js, args.rounds)*1000))
+    print("Decode binary: {:.3f} ms/block".format(timed(codec_utils.decode, bs, args.rounds)*1000))
+
+def traced_size(build):
+    # Memory held by the result of build
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, result
+
+def bench_memory(args):
+    wallets = [sample_wallet() for _ in range(args.wallets)]
+    print("Tokens per block: {}, wallets: {}".format(args.tokens, args.wallets))
+    print("{:>8} {:>14} {:>14} {:>8}".format("blocks", "dict B/block", "Block B/block", "ratio"))
+    for n in args.sizes:
+        # Blocks as they are read from disk or from a peer
+        raw = [json.dumps(sample_block(i, args.tokens, wallets)) for i in range(n)]
+        objs, blocks = traced_size(lambda: [Block.from_dict(json.loads(s)) for s in raw])
+        dicts, chain = traced_size(lambda: [json.loads(s) for s in raw])
+        assert [b.to_dict() for b in blocks] == chain
+        del blocks, chain
+        print("{:>8} {:>14,.0f} {:>14,.0f} {:>8.0%}".format(n, dicts/n, objs/n, objs/dicts))
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="bench")
+    p = sub.add_parser("pow", help="Proof of work hashes per second")
+    p.add_argument("-n","--nonces",default=1000000,type=int,help="Nonces to test")
+    p = sub.add_parser("codec", help="Size and speed of the binary encoding against json")
+    p.add_argument("-b","--blocks",default=20,type=int,help="Number of blocks")
+    p.add_argument("-t","--tokens",default=100,type=int,help="Transactions per block")
+    p.add_argument("-w","--wallets",default=100,type=int,help="Different addresses in the transactions")
+    p.add_argument("-r","--rounds",default=5,type=int,help="Times each block is encoded and decoded")
+    p = sub.add_parser("memory", help="Memory per block of the chain as dicts and as Block objects")
+    p.add_argument("-s","--sizes",default=[100, 1000, 5000],type=int,nargs="+",help="Chain sizes")
+    p.add_argument("-t","--tokens",default=10,type=int,help="Transactions per block")
+    p.add_argument("-w","--wallets",default=100,type=int,help="Different addresses in the transactions")
+    args = parser.parse_args()
+
+    benches = {
+        "pow": bench_pow,
+        "codec": bench_codec,
+        "memory": bench_memory,
+    }
+    if args.bench in benches:
+        benches[args.bench](args)
+    else:
+        parser.print_help()
@@ -3,8 +3,19 @@ from wallet_utils import *
 from chain_utils import *
 from transaction_utils import *
 from utils import *
+from cache_utils import LRUCache
+from mempool import Mempool
+from index_utils import TransactionIndex
+from broadcast_utils import Broadcaster, TransactionBatcher
+from blocktree import BlockTree
+from blocktemplate import BlockTemplate
+from metrics_utils import MiningMetrics
+from merkle_utils import merkle_root, merkle_proof
+import codec_utils
+from pow_utils import *
 from ecdsa.keys import BadSignatureError
-import threading, requests
+from concurrent.futures import ProcessPoolExecutor
+import threading, requests, multiprocessing, itertools
 from urllib.parse import urlparse
 
 """
@@ -20,8 +31,10 @@ def _mcontroller(func):
         print("STARTING MINE")
         st = time.time()
         self.mining = True
-        nb = func(self)
-        self.mining = False
+        try:
+            nb = func(self)
+        finally:
+            self.mining = False
         et = time.time()-st
         print("ENDING MINE - {:.2f}s".format(et))
         save_time(et)
@@ -29,26 +42,112 @@ def _mcontroller(func):
     return mine_controller
 
 class Blockchain:
-    
-    BLOCK_SIZE = 10
+
+    # (hash, signature) of the transactions whose signature was already verified in this process
+    verified_transactions = LRUCache(config.verified_cache_size)
 
     def __init__(self, uid, port=5000):
+        st = time.time()
         self.port = port
         self.node_uid = uid
         self.chain = load_chain()
-        self.current_transactions = load_transactions()
+        self.current_transactions = Mempool(load_transactions(), config.mempool_size)
+        self.save_timer = None
+        self.save_lock = threading.Lock()
         self.wallet = get_wallet()
         self.nodes = load_data("nodes.json")
-        self.chain_transaction_hashes = set()
+        self.broadcaster = Broadcaster()
+        self.tx_batcher = TransactionBatcher(self.spread_transactions)
+        self.tx_index = self.init_tx_index()
+        self.tree = BlockTree()
+        self.chain_lock = threading.RLock()
         self.resolving_chains = False
         self.resolving_transactions = False
         self.mining = False
-        self.miningStop = False
+        # Cancellation of the current PoW search, cancelled when the tip changes
+        self.mining_job = None
+        self.metrics = MiningMetrics()
+        self.template = None
+        self.template_lock = threading.Lock()
+        self.template_stats = None
+        self.valid_chain = True
+        self.state = self.init_state()
         # Creates the genesis block
         if len(self.chain)==0:
             self.update_chain(self.create_genesis_block())
+        else:
+            self.refresh_template_later()
+        self.startup_time = time.time()-st
+        print("Node started in {:.3f}s, height {}".format(self.startup_time, len(self.chain)))
+
+    def init_tx_index(self):
+        """
+        Loads the confirmed transactions index, it's only rebuilt from the chain if it's missing.
+        The blocks indexed without an undo record are indexed again, state_at needs them on a reorg.
+
+        :return: <TransactionIndex> Index matching the chain.
+        """
+        index = TransactionIndex()
+        if not index.load():
+            print("Building transaction index")
+        # The stored chain was validated when it was added, its signatures aren't checked again
+        index.sync(self.chain, lambda state, block: self.apply_block(state, block, [True]*len(block.tokens)))
+        return index
+
+    def init_state(self):
+        """
+        Loads the saved balance state if it matches the last block. Otherwise the newest saved
+        state or checkpoint that matches a block of the chain is used and only the blocks after
+        it are replayed, or the whole chain if none matches.
+
+        :return: <dict> Balance state of the chain.
+        """
+        if len(self.chain)==0:
+            return {}
+        saved = load_state()
+        if saved is not None and saved['hash']==self.last_block.hash and saved['block_n']==self.last_block.block_n:
+            return saved['balances']
+        candidates = [saved] if saved is not None else []
+        candidates.extend(load_checkpoints())
+        for checkpoint in sorted(candidates, key=lambda c: c['block_n'], reverse=True):
+            n = checkpoint['block_n']
+            if n < len(self.chain) and self.chain[n].hash==checkpoint['hash']:
+                print("Saved state does not match the chain, replaying it from block {}".format(n))
+                return self.rebuild_state(checkpoint)
+        print("Saved state does not match the chain, rebuilding it")
+        return self.rebuild_state()
+
+    def rebuild_state(self, checkpoint=None):
+        """
+        Replays and validates the chain to rebuild the balance state.
+
+        :param checkpoint: <dict> (Optional) Saved state at a block of the chain, only the blocks after it are replayed.
+        :return: <dict> Balance state of the chain.
+        """
+        if checkpoint is None:
+            state = self.is_valid_chain()
+        else:
+            n = checkpoint['block_n']
+            state = self.is_valid_chain(self.chain[n+1:], parent=self.chain[n], state=checkpoint['balances'])
+        self.valid_chain = state is not False
+        if not self.valid_chain:
+            print("INVALID CURRENT CHAIN!")
+            state = {}
+        self.state = state
+        save_state(self.state, self.last_block)
+        return state
 
-    def new_block(self, n, timestamp, tokens, previous_hash, previous_pow=None):
+    def validate_chain(self):
+        """
+        Full revalidation of the chain, replaying every block from the genesis block.
+        The cached state is replaced by the result.
+
+        :return: <bool> True if the chain is valid.
+        """
+        self.rebuild_state()
+        return self.valid_chain
+
+    def new_block(self, n, timestamp, tokens, previous_hash, previous_pow=None, target=None):
         """
         Create a new Block in the Blockchain
 
@@ -57,23 +156,34 @@ class Blockchain:
         :param tokens: <list> Tokens
         :param previous_hash: <str> String representation of the hash of the previous block
         :param previous_pow: <int> Power of Work of the previous block
-        :return: <dict> New Block
+        :param target: <int> (Optional) Target of the proof of work, default to the initial target.
+        :return: <Block> New Block
         """
 
         # Create the reward transaction for the miner
         t = self.create_reward_transaction(self.wallet)
 
         # Create a copy of the tokens and append the reward transaction
-        tokens = tokens.copy()
+        tokens = list(tokens)
         tokens.append(t)
 
         # Check the tokens/transactions
-        state = self.is_valid_chain()
+        state = self.state
         for t in tokens:
             if self.is_valid_transaction(state,t):
                 state = self.update_state(state, t)
             else:
                 raise Exception("Error creating block, invalid transactions found")
+        return self.seal_block(n, timestamp, tokens, previous_hash, previous_pow, target)
+
+    def seal_block(self, n, timestamp, tokens, previous_hash, previous_pow=None, target=None, cancel=None):
+        """
+        Creates a Block with already validated tokens, searching its proof of work.
+        Arguments as in new_block, tokens include the reward transaction, and cancel as in next_pow.
+
+        :return: <Block> New Block or <None> if the mining was interrupted.
+        """
+
         # Correct the timestamp
         if isinstance(timestamp, datetime.datetime):
             timestamp = timestamp.isoformat()
@@ -87,21 +197,20 @@ class Blockchain:
             'tokens': tokens,
             'miner': self.wallet['address'],
             'previous_hash': previous_hash,
+            'merkle_root': merkle_root([t.leaf for t in tokens]),
+            'target': initial_target() if target is None else target,
         }
 
         pow = 9
         if previous_pow is not None:
             try:
-                pow = self.next_pow(previous_pow, previous_hash)
+                pow = self.next_pow(previous_pow, previous_hash, block['target'], cancel)
                 print("pow calculed")
             except Exception as e:
                 print("Error:",str(e))
                 return None
-        block['pow'] = pow
-        # Add the hash to the block
-        block['hash'] = self.hash_block(block)
-
-        return block
+        # Freeze the block adding its hash
+        return Block.sealed(pow=pow, **block)
 
     def create_genesis_block(self):
         """
@@ -119,75 +228,269 @@ class Blockchain:
         # Get the last block, it's hash and block_n
         last_block = self.last_block
         last_block_hash = self.hash_block(last_block)
-        n = last_block['block_n']
+        n = last_block.block_n
+
+        target = next_target(last_block, lambda h: self.chain[h])
 
-        return self.new_block(n+1, datetime.datetime.now(), tokens, last_block_hash, last_block['pow'])
+        return self.new_block(n+1, datetime.datetime.now(), tokens, last_block_hash, last_block.pow, target)
 
     def update_chain(self, block):
         """
         Adds a new block to the chain
 
-        :param block: <dict> Block to add.
+        :param block: <Block> Block to add.
         """
+        with self.chain_lock:
+            return self._update_chain(block)
+
+    def _update_chain(self, block):
         if (len(self.chain)==0 and self.is_genesis_block(block)) or self.is_valid_next_block(self.last_block, block):
-            self.miningStop = True
+            applied = self.apply_block(self.state, block)
+            if applied is None:
+                print("Invalid transactions on block:",block.block_n)
+                return False
+            self.cancel_mining()
             self.chain.append(block)
-            save_chain(self.chain)
+            self.state, undo = applied
+            save_state(self.state, block)
+            if block.block_n % config.checkpoint_interval == 0:
+                save_checkpoint(self.state, block)
+            self.tx_index.add_block(block, undo)
             self.clean_transactions()
-            threading.Thread(target=self.spread_block,args=(self.nodes, block, self.port)).start()
+            self.refresh_template_later()
+            self.spread_block(block)
 
             return True
         else:
             return False
     
+    def height_of(self, h):
+        """
+        :param h: <str> Block hash.
+        :return: <int> Height of the block in the main chain or <None>.
+        """
+        n = get_store().height_of(h)
+        return n if n is not None and n < len(self.chain) and self.chain[n].hash==h else None
+
+    def receive_block(self, block):
+        """
+        Handles a block from a node: extends the chain, keeps it as a side block (switching to its
+        branch if it has more work than the main chain) or keeps it as an orphan until its parent arrives.
+
+        :param block: <Block> Block recived.
+        :return: <str> 'added', 'reorg', 'side', 'orphan', 'known' or 'invalid'.
+        """
+
+        with self.chain_lock:
+            h = block.hash
+            if self.height_of(h) is not None or h in self.tree:
+                return "known"
+            if h != self.hash_block(block) or not block.has_valid_body():
+                return "invalid"
+
+            ph = block.previous_hash
+            if ph == self.last_block.hash:
+                status = "added" if self._update_chain(block) else "invalid"
+            else:
+                n = self.height_of(ph)
+                parent = self.chain[n] if n is not None else self.tree.get(ph)
+                if parent is None:
+                    self.tree.add_orphan(block)
+                    return "orphan"
+                # Stateless checks, the balances are checked if the branch becomes the main chain
+                if block.block_n != parent.block_n+1 or not self.is_valid_proof(parent.pow, parent.hash, block.pow, block_target(block)):
+                    return "invalid"
+                self.tree.add(block)
+                status = self.try_branch(block)
+
+            # Connect the orphans that were waiting for this block
+            if status not in ("invalid", "orphan"):
+                for child in self.tree.pop_orphans(h):
+                    self.receive_block(child)
+            return status
+
+    def has_more_work(self, fork, blocks):
+        """
+        Compares the work of some blocks after a fork point with the work of the main chain after it.
+
+        :param fork: <int> Number of blocks in common.
+        :param blocks: <list> Blocks after the fork point.
+        :return: <bool> True if blocks have more work.
+        """
+        return sum(block_work(b) for b in blocks) > sum(block_work(b) for b in self.chain[fork:])
+
+    def try_branch(self, block):
+        """
+        Switches the main chain to the branch ending in a side block if it has more work.
+        Only the blocks after the fork point are undone and validated.
+
+        :param block: <Block> Side block.
+        :return: <str> 'reorg', 'side', 'orphan' or 'invalid'.
+        """
+        found = self.tree.branch(block, self.height_of)
+        if found is None:
+            # A side ancestor was dropped, wait for it again
+            self.tree.orphan_branch(block)
+            return "orphan"
+        fork, branch = found
+        if not self.has_more_work(fork, branch):
+            return "side"
+        print("Branch of block {} has more work, switching from block {}".format(block.block_n, fork))
+        undo = []
+        state = self.is_valid_chain(branch, parent=self.chain[fork-1], state=self.state_at(fork), undo=undo)
+        if state is False:
+            # The blocks before the invalid one are valid, other branches can share them
+            print("Invalid branch from block {}".format(branch[len(undo)].block_n))
+            for b in branch[len(undo):]:
+                self.tree.remove(b.hash)
+            return "invalid"
+        self.switch_chain(fork, branch, state, undo)
+        self.spread_block(self.last_block)
+        return "reorg"
+
+    def switch_chain(self, fork, blocks, state, undo):
+        """
+        Replaces the blocks of the main chain after a fork point with validated ones.
+
+        :param fork: <int> Number of blocks in common.
+        :param blocks: <list> New blocks after the fork point.
+        :param state: <dict> State at the end of blocks.
+        :param undo: <list> Undo record of each new block.
+        """
+        with self.chain_lock:
+            removed = self.chain[fork:]
+            self.chain.replace(fork, blocks)
+            self.cancel_mining()
+            self.state = state
+            self.valid_chain = True
+            save_state(self.state, self.last_block)
+            self.save_checkpoints(blocks, state, undo)
+            self.tx_index.rollback(fork)
+            for block, u in zip(blocks, undo):
+                self.tx_index.add_block(block, u)
+
+            # Keep the old blocks as side blocks so we can switch back
+            for block in removed:
+                self.tree.add(block)
+            for block in blocks:
+                self.tree.remove(block.hash)
+            self.tree.prune(len(self.chain)-config.max_reorg_depth)
+
+            # The transactions of the old blocks go back to the pool if they are still valid
+            self.update_transactions([t for b in removed for t in b.tokens if t.sender!='0'])
+            self.clean_transactions()
+            self.refresh_template_later()
+
     def update_transactions(self,transactions):
+        """
+        Validates a batch of transactions against a single state snapshot and adds the valid ones to the transaction pool.
+
+        :param transactions: <list> Transactions to add.
+        :return: <list> <bool> True for each transaction added.
+        """
+        state = self.state
         r = []
         for t in transactions:
-            r.append(self.update_transaction(t))
+            r.append(self.is_valid_pending_transaction(t, state) and self.update_transaction(t))
         return r
 
     def update_transaction(self, transaction):
         """
         Adds a new transaction to the transaction pool.
 
-        :param transaction: <dict> Transaction to add.
+        :param transaction: <Transaction> Transaction to add.
         :return: <bool> True if the transaction was successfully added.
         """
-        hashes = [t['hash'] for t in self.current_transactions]
-        if transaction['hash'] not in hashes and transaction['hash'] not in self.get_transaction_hashes():
-            self.current_transactions.append(transaction)
-            save_transactions(self.current_transactions)
-            threading.Thread(target=self.spread_transaction,args=(self.nodes,transaction,)).start()
+        if transaction.hash not in self.current_transactions and transaction.hash not in self.get_transaction_hashes():
+            self.current_transactions.add(transaction)
+            self.persist_transactions()
+            self.tx_batcher.add(transaction)
+            with self.template_lock:
+                if self.template is not None:
+                    self.template.push(transaction)
             return True
         else:
             return False
+    def persist_transactions(self):
+        """
+        Saves the pending transactions, at most once every config.mempool_save_delay seconds.
+        """
+        with self.save_lock:
+            if self.save_timer is None:
+                self.save_timer = threading.Timer(config.mempool_save_delay, self.save_transactions_now)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+
+    def save_transactions_now(self):
+        """
+        Saves the pending transactions immediately.
+        """
+        with self.save_lock:
+            self.save_timer = None
+        save_transactions(self.current_transactions.to_list())
+
+    def is_valid_pending_transaction(self, txn, state=None):
+        """
+        Checks if a transaction can enter the transaction pool: it must be valid and the sender
+        funds minus the amount reserved by its pending transactions must cover it.
+
+        :param txn: <Transaction> Transaction to check.
+        :param state: <dict> (Optional) State snapshot to check against, default to the current state.
+        :return: <bool> True if the transaction is valid.
+        """
+        if state is None:
+            state = self.state
+        if not self.verify_transaction(txn):
+            return False
+        if txn.sender=='0':
+            return True
+        # The reservations are kept by sender, it must be the address of the signer
+        sender = calculate_address(txn.public_key)
+        if txn.sender!=sender:
+            return False
+        return state.get(sender,0)-self.current_transactions.reserved_by(sender)>=txn.amount
+
     @staticmethod
     def is_genesis_block(block):
-        return block['block_n']==0 and len(block['tokens'])==1 and block['previous_hash'] == "0" and block['pow'] == 9
-    @staticmethod
-    def spread_transaction(nodes, transaction):
-        print("="*50)
-        print("Starting transaction: {} spread.".format(transaction['hash']))
-        for node in nodes:
-            print("Sending transaction to:",node)
-            data = json.dumps(transaction, sort_keys=True)
-            r = requests.post(node+"/transactions/add", data=data)
-            print("status:",r.status_code)
-        print("End transaction spread")
-        print("="*50)
-    
-    @staticmethod
-    def spread_block(nodes,block,port=5000):
-        print("="*50)
-        print("Starting block {} spreading.".format(block['block_n']))
-        for node in nodes:
-            print("Sending block to",node)
-            data = json.dumps(block, sort_keys=True)
-            headers = {"port":str(port)}
-            r = requests.post(node+"/chain/add",headers=headers,data=data)
-            print("status:",r.status_code)
-        print("End block spread.")
-        print("="*50)
+        return block.block_n==0 and len(block.tokens)==1 and block.previous_hash == "0" and block.pow == 9
+    def spread_transactions(self, transactions):
+        """
+        Sends a batch of transactions to all the nodes concurrently in a single message.
+
+        :param transactions: <list> Transactions to spread.
+        :return: <list> Futures of the requests.
+        """
+        print("Spreading {} transactions".format(len(transactions)))
+        transactions = [t.to_dict() for t in transactions]
+        data = json.dumps(transactions, sort_keys=True)
+        return self.broadcaster.broadcast(self.nodes, "/transactions/add/batch", data, binary=codec_utils.encode(transactions))
+
+    def spread_block(self, block):
+        """
+        Sends a block to all the nodes concurrently.
+
+        :param block: <Block> Block to spread.
+        :return: <list> Futures of the requests.
+        """
+        print("Spreading block {}".format(block.block_n))
+        h = block.hash
+        block = block.to_dict()
+        data = json.dumps(block, sort_keys=True)
+        headers = {"port":str(self.port)}
+        futures = self.broadcaster.broadcast(self.nodes, "/chain/add", data, headers, binary=codec_utils.encode(block))
+        for f in futures:
+            f.add_done_callback(lambda f: self.block_spread_done(h, f.result()))
+        return futures
+
+    def block_spread_done(self, h, response):
+        """
+        Records when a node accepts a block we found (see MiningMetrics.block_accepted).
+
+        :param h: <str> Block hash.
+        :param response: <requests.Response> Response of the node or <None> if the request failed.
+        """
+        if response is not None and response.status_code == 201:
+            self.metrics.block_accepted(h)
 
     # Deprecated function!!!
     # def new_transaction(self, sender, recipient, amount):
@@ -206,27 +509,79 @@ class Blockchain:
     #     })
     #     return self.last_block['index'] + 1
     
-    def next_pow(self, last_proof, last_hash):
+    def next_pow(self, last_proof, last_hash, target=None, cancel=None):
         """
         Given the last_block proof and hash it creates the proof of work for the next block
 
         :param last_proof: <int> PoW of the last block
         :param last_hash: <str> String representation of the hash of the last block
+        :param target: <int> (Optional) Target of the next block, default to the initial target.
+        :param cancel: <Cancellation> (Optional) Cancellation of the search, default to a new mining job.
         :return: <int> Next valid PoW
         """
 
+        if cancel is None:
+            cancel = self.start_mining_job()
+
+        self.metrics.start_search()
+        result = 'failed'
+        try:
+            proof = self.search_pow(last_proof, last_hash, target, cancel)
+            result = 'found'
+            return proof
+        except Exception:
+            if cancel.is_set():
+                result = 'interrupted'
+            raise
+        finally:
+            self.metrics.end_search(result)
+
+    def search_pow(self, last_proof, last_hash, target, cancel):
+        """
+        Proof of work search of next_pow, reporting the nonces tried to the metrics.
+        """
+
+        # Split the search across worker processes if configured
+        if config.mining_workers > 1:
+            proof = parallel_pow(last_proof, last_hash, target, config.mining_workers, cancel, self.metrics.progress)
+            if proof is None:
+                raise Exception("Mining interruption")
+            return proof
+
         # Set initial value to 0
         proof = 0
-        
-        # Iterate to get the correct proof
-        while not self.is_valid_proof(last_proof, last_hash, proof):
+        engine = ProofEngine(last_proof, last_hash, target)
+        batch = config.mining_check_interval
+
+        # Iterate over batches of nonces to get the correct proof
+        while True:
+            found = engine.search(proof, proof+batch)
+            if found is not None:
+                self.metrics.progress(found+1)
+                return found
+            proof += batch
+            self.metrics.progress(proof)
             if proof%1000000==0:
                 print("PoW:",proof)
-            if self.miningStop:
-                self.miningStop = False
+            if cancel.is_set():
                 raise Exception("Mining interruption")
-            proof += 1
-        return proof
+
+    def start_mining_job(self):
+        """
+        :return: <Cancellation> Cancellation of a new PoW search, it's cancelled when the tip changes.
+        """
+        job = Cancellation()
+        with self.chain_lock:
+            self.mining_job = job
+        return job
+
+    def cancel_mining(self):
+        """
+        Cancels the current PoW search, its parent is no longer the tip.
+        """
+        job = self.mining_job
+        if job is not None:
+            job.cancel()
 
     # Deprecated function!!!
     # @staticmethod
@@ -249,7 +604,7 @@ class Blockchain:
     #     """
     #     Creates a SHA-256 hash of a Block
 
-    #     :param block: <dict> Block
+    #     :param block: <Block> Block
     #     :return: <str>
     #     """
     #     block_string = json.dumps(block, sort_keys=True).encode()
@@ -259,43 +614,47 @@ class Blockchain:
         """
         Checks if a given block is valid considering it's parent.
 
-        :param last_block: <dict> Previous block dict.
-        :param block: <dict> Block dict to add.
+        :param last_block: <Block> Previous block dict.
+        :param block: <Block> Block dict to add.
         :return: <bool> True if it's valid.
         """
 
-        # Check if the given block hash it's equal to computed hash
-        scheck = block['hash'] == self.hash_block(block)
+        # Check if the given block hash it's equal to computed hash and the tokens match the header
+        scheck = block.hash == self.hash_block(block) and block.has_valid_body()
 
         # Check if last_block hash field it's equal to it's computed hash
-        lcheck = last_block['hash'] == self.hash_block(last_block)
+        lcheck = last_block.hash == self.hash_block(last_block)
 
         # Check if new block previous_hash it's equal to real last_block hash
-        pcheck = block['previous_hash'] == last_block['hash']
+        pcheck = block.previous_hash == last_block.hash
 
         # Check if new block index it's equal to last_block's index + 1
-        ncheck = block['block_n'] == last_block['block_n'] + 1
+        ncheck = block.block_n == last_block.block_n + 1
 
         # Check if proof of work algorithm it's correct
-        powcheck = self.is_valid_proof(last_block['pow'], last_block['hash'], block['pow'])
+        powcheck = self.is_valid_proof(last_block.pow, last_block.hash, block.pow, block_target(block))
+
+        # Check if the timestamp it's after the median of the last blocks and not too far in the future
+        timecheck = is_valid_timestamp(last_block, block, lambda h: self.chain[h])
 
-        print("Check of block:",block['block_n'],"and last_block:",last_block['block_n'],":",scheck,lcheck,pcheck,ncheck,powcheck)
+        # Check if the target it's the one expected after last_block
+        tcheck = is_valid_target(last_block, block, lambda h: self.chain[h])
 
-        return scheck and lcheck and pcheck and ncheck and powcheck
+        print("Check of block:",block.block_n,"and last_block:",last_block.block_n,":",scheck,lcheck,pcheck,ncheck,powcheck,timecheck,tcheck)
+
+        return scheck and lcheck and pcheck and ncheck and powcheck and timecheck and tcheck
 
     @staticmethod
-    def is_valid_proof(last_proof, last_hash, proof):
+    def is_valid_proof(last_proof, last_hash, proof, target=None):
         """
         Checks if the proof of work it's correct.
 
         :param last_proof: <int> The value of the PoW of the previous block
         :param last_hash: <str> The String representation of the hash of the previous block.
+        :param target: <int> (Optional) Target of the block, default to the initial target.
         :return: <bool> True if the proof is valid.
         """
-        guess = f'{last_proof}{last_hash}{proof}'.encode()
-        guess_hash = sha(guess).hex()
-        n = 6
-        return guess_hash[:n] == "0"*n
+        return is_valid_proof(last_proof, last_hash, proof, target)
     
     @property
     def last_block(self):
@@ -307,39 +666,27 @@ class Blockchain:
         """
         Creates a hash of the block excluding the 'hash' field if it exists (it should be the same as computed here)
 
-        :param block: <dict> Block dict
+        :param block: <Block> Block dict
         :return: <str> String representation of sha-256 hash of the block
         """
 
-        # Create a copy of the block
-        block = block.copy()
-
-        # Delete the field "hash" to avoid wrong output
-        if "hash" in block:
-            del block["hash"]
-
-        # return hexdigest
-        return hashlib.sha256(json.dumps(block, sort_keys=True).encode()).hexdigest()
+        # Immutable blocks keep their hash once computed
+        return Block.from_dict(block).digest
     @staticmethod
     def hash_transaction(txn):
         """
         Creates a hash of a transaction dict excluding the signature and hash fields.
 
-        :param txn: <dict> Transaction to hash.
+        :param txn: <Transaction> Transaction to hash.
         :return: <str> String representation of the transaction hash.
         """
 
-        # Create a copy of the transaction
-        tx = copy.deepcopy(txn)
+        # Immutable transactions keep their hash once computed
+        if isinstance(txn, Transaction):
+            return txn.digest
 
         # Exclude hash and signature
-        to_exclude = ["hash","signature"]
-        for d in to_exclude:
-            if d in tx:
-                del tx[d]
-        
-        # Return hexdigest
-        return hashlib.sha256(json.dumps(tx, sort_keys=True).encode()).hexdigest()
+        return hash_fields(txn, Transaction.HASH_EXCLUDE)
 
     @staticmethod
     def create_transaction(wallet, recipient, amount):
@@ -349,7 +696,7 @@ class Blockchain:
         :param wallet: <dict> Sender's wallet dict.
         :param recipient: <str> String representation of recipient address
         :param amount: <float> Amount to transfer
-        :return: <dict> New transaction
+        :return: <Transaction> New transaction
         """
 
         # Get the public and private keys
@@ -375,7 +722,7 @@ class Blockchain:
         e = ECDSA(privatekey=bytes.fromhex(private))
         t['signature'] = e.sign(t).hex()
 
-        return t
+        return Transaction.from_dict(t)
 
     @staticmethod
     def create_reward_transaction(wallet):
@@ -383,7 +730,7 @@ class Blockchain:
         Create the reward transaction for the miner.
 
         :param wallet: <dict> Wallet of the miner.
-        :return: <dict> Reward transaction or <bool> False if error occurred
+        :return: <Transaction> Reward transaction or <bool> False if error occurred
         """
 
         # Check if wallet address equals our computation
@@ -412,111 +759,192 @@ class Blockchain:
         # Sign the transaction
         t['signature'] = e.sign(t).hex()
 
-        return t
+        return Transaction.from_dict(t)
 
 
     @staticmethod
-    def is_valid_transaction(state, txn):
+    def verify_transaction(txn):
         """
-        Checks if a desired transaction is valid
+        Stateless checks of a transaction: required fields, hash and signature.
 
-        :param state: <dict> Current statte of the network at the moment of last block
-        :param txn: <dict> Transaction to check
-        :return: <bool> True if the transaction is valid.
+        :param txn: <Transaction> Transaction to check
+        :return: <bool> True if the transaction is well formed and correctly signed.
         """
-        
-        # Check required transaction fields
-        required = ['sender', 'recipient', 'amount', 'timestamp', 'public_key', 'signature', 'hash']
-        for r in required:
-            if r not in txn:
-                print("Missing keys")
-                return False
+
+        # The required fields are checked when the Transaction is created (from_dict)
 
         # First check if the hash is correct
-        if txn['hash']!=Blockchain.hash_transaction(txn):
+        if txn.hash!=Blockchain.hash_transaction(txn):
             print("incorrect hash")
             return False
 
-        if txn['sender']=='0':
+        # Reward transactions (sender='0') are not signed by a wallet
+        if txn.sender=='0':
             return True
 
-        # First get the public key
-        public = txn['public_key']
-
-        # Calculate the address of the sender
-        sender = calculate_address(public)
+        # The hash matches the content, so a cached (hash, signature) means the same signed transaction
+        key = (txn.hash, txn.signature)
+        if Blockchain.verified_transactions.get(key, False):
+            return True
 
         # Create a ECDSA object with the current public key
-        e = ECDSA(publickey=bytes.fromhex(public))
+        e = ECDSA(publickey=bytes.fromhex(txn.public_key))
 
-        # Get the amount to transfer
-        amount = txn['amount']
+        # Get the signature
+        s = txn.signature
 
-        # Get the signature and the recipient address
-        s = txn['signature']
-        recipient = txn['recipient']
-
-        # Make a copy and delete the signature to verify
-        v = txn.copy()
+        # Get the signed content, without the signature
+        v = txn.to_dict()
         del v['signature']
 
-        # It's valid if it's a reward transaction (sender='0') or if it's a normal transaction (sender=<current wallet address> and the signature verifies the content)
         try:
             e.verify(s, v)
-            verified = True
+            Blockchain.verified_transactions.put(key)
+            return True
         except BadSignatureError:
             print("Signatre error")
-            verified = False
+            return False
 
-        return verified and state.get(sender,0)>=amount
+    @staticmethod
+    def is_valid_transaction(state, txn, verified=None):
+        """
+        Checks if a desired transaction is valid
 
-    def is_valid_chain(self, chain=None):
+        :param state: <dict> Current statte of the network at the moment of last block
+        :param txn: <Transaction> Transaction to check
+        :param verified: <bool> (Optional) Result of verify_transaction if it was already computed.
+        :return: <bool> True if the transaction is valid.
         """
-        Iterates all over a chain and checks that all hashes and signatures are correct
 
-        :param chain: <dict> (Optional) Set a chain diferent to self to check.
-        :return: <dict> State of the blockchain if the chain is valid, otherwise <bool> False.
+        if verified is None:
+            verified = Blockchain.verify_transaction(txn)
+
+        # It's valid if it's a reward transaction (sender='0') or if it's a normal transaction (sender=<current wallet address> and the signature verifies the content)
+        if not verified:
+            return False
+        if txn.sender=='0':
+            return True
+
+        # Calculate the address of the sender, it must be the one debited, and check its funds
+        sender = calculate_address(txn.public_key)
+        if txn.sender!=sender:
+            return False
+        return state.get(sender,0)>=txn.amount
+
+    @staticmethod
+    def verify_block(job):
         """
+        Stateless checks of a block: its hash, its PoW (against the target in its header) and the hash and signature of every token.
+        It doesn't need the rest of the chain, so it can run on a worker process.
 
-        # Create a copy of the chain
-        if chain is None:
-            chain = copy.deepcopy(self.chain)
-        else:
-            chain = copy.deepcopy(chain)
-        
-        # If chain it's empty, nobody owns nothing
-        if len(chain)==0:
-            return {}
+        :param job: <tuple> (previous pow, previous hash, block), previous values are None for the genesis block.
+        :return: <tuple> (<bool> hash and Merkle root check, <bool> PoW check, <list> verify_transaction result of each token)
+        """
+        last_proof, last_hash, block = job
+        hcheck = block.hash == Blockchain.hash_block(block) and block.has_valid_body()
+        powcheck = last_hash is None or Blockchain.is_valid_proof(last_proof, last_hash, block.pow, block_target(block))
+        return hcheck, powcheck, [Blockchain.verify_transaction(t) for t in block.tokens]
 
-        # Exclude the genesis block
-        gb = chain.pop(0)
+    def is_valid_chain(self, chain=None, workers=None, parent=None, state=None, undo=None):
+        """
+        Iterates all over a chain and checks that all hashes and signatures are correct.
+        The stateless checks (verify_block) run on a pool of processes while the
+        balances are updated sequentially in block order.
+
+        :param chain: <list> (Optional) Set a chain diferent to self to check, it can be a generator of blocks.
+        :param workers: <int> (Optional) Number of processes, default to config.validation_workers.
+        :param parent: <Block> (Optional) Block before the first one of chain, to check only a suffix of a chain.
+        :param state: <dict> (Optional) State at parent, default to a empty state.
+        :param undo: <list> (Optional) If given, the undo record of each block is appended to it.
+        :return: <dict> State of the blockchain if the chain is valid, otherwise <bool> False.
+        """
 
-        # Define a empty state
-        state = {}
+        if chain is None:
+            chain = self.chain
+        if workers is None:
+            workers = config.validation_workers
+        if state is None:
+            state = {}
+
+        # The chain can be a generator, it's read by windows of blocks
+        blocks = iter(chain)
+        window = max(1, workers)*config.validation_window
+
+        executor = None
+        if workers > 1:
+            ctx = multiprocessing.get_context(config.mining_start_method)
+            executor = ProcessPoolExecutor(workers, mp_context=ctx)
+
+        def verify(batch, prev):
+            # Each block is checked against it's parent pow and hash
+            jobs = []
+            for block in batch:
+                jobs.append((None, None, block) if prev is None else (prev.pow, prev.hash, block))
+                prev = block
+            if executor is not None and len(jobs) > 1:
+                return executor.map(self.verify_block, jobs, chunksize=max(1, len(jobs)//(workers*4)))
+            return map(self.verify_block, jobs)
+
+        # Blocks later ones look back at: the one that starts the current retarget interval and the
+        # last config.median_time_blocks ones. The ones before the chain are in self.chain (parent is
+        # a block of the main chain)
+        interval_starts = {}
+        recent = {}
+        def ancestor(h):
+            if h in recent:
+                return recent[h]
+            return interval_starts[h] if h in interval_starts else self.chain[h]
 
-        # Check if the genesis block is correct
-        if gb['hash'] != self.hash_block(gb) or gb['block_n']!=0:
-            return False
+        try:
+            last_block, last_hcheck = parent, True
+            batch = list(itertools.islice(blocks, window))
+            results = verify(batch, parent)
+            while batch:
+                # The pool verifies the next window while the current one is folded
+                next_batch = list(itertools.islice(blocks, window))
+                next_results = verify(next_batch, batch[-1]) if next_batch else None
+
+                for block, (hcheck, powcheck, verified) in zip(batch, results):
+                    timecheck = is_valid_timestamp(last_block, block, ancestor)
+                    tcheck = is_valid_target(last_block, block, ancestor)
+                    if last_block is None:
+                        # Check if the genesis block is correct
+                        valid = hcheck and timecheck and tcheck and block.block_n==0
+                    else:
+                        # Check the block and it's link with the previous one
+                        pcheck = block.previous_hash == last_block.hash
+                        ncheck = block.block_n == last_block.block_n + 1
+                        valid = hcheck and last_hcheck and pcheck and ncheck and powcheck and timecheck and tcheck
+                    if not valid:
+                        # If invalid, return False
+                        print("Error on block:",block.block_n)
+                        return False
+
+                    # If valid, update state and remember the signatures checked by the workers
+                    applied = self.apply_block(state, block, verified)
+                    if applied is None:
+                        print("Invalid transactions on block:",block.block_n)
+                        return False
+                    state, u = applied
+                    if undo is not None:
+                        undo.append(u)
+                    if executor is not None:
+                        for t, v in zip(block.tokens, verified):
+                            if v and t.sender!='0':
+                                self.verified_transactions.put((t.hash, t.signature))
+                    if block.block_n % config.retarget_interval == 0:
+                        # Only the last one is needed
+                        interval_starts.clear()
+                        interval_starts[block.block_n] = block
+                    recent[block.block_n] = block
+                    recent.pop(block.block_n-config.median_time_blocks, None)
+                    last_block, last_hcheck = block, hcheck
+                batch, results = next_batch, next_results
+            return state
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
 
-        # Update state
-        state = self.update_state(state, gb['tokens'])
-        last_block = gb
-
-        # Iterate over all other blocks
-        for i in range(len(chain)):
-            # Get the following block and check if it's valid
-            block = chain[i]
-            if self.is_valid_next_block(last_block, block):
-                # If valid, update state
-                tokens = block['tokens']
-                state = self.update_state(state, tokens)
-            else:
-                # If invalid, return False
-                print("Error on block:",i)
-                return False
-            last_block = block
-        return state
-    
     def is_valid_node(self, node):
         """
         Checks if the node is a valid node.
@@ -527,7 +955,7 @@ class Blockchain:
 
         try:
             lb = self.last_block
-            data = json.dumps(lb)
+            data = json.dumps(lb.to_dict())
             headers = {"port":str(self.port)}
             r = requests.post(node+"/chain/add",headers=headers, data=data)
             return True
@@ -596,12 +1024,13 @@ class Blockchain:
         return False
 
     @staticmethod
-    def update_state(state,txn):
+    def update_state(state,txn,verified=None):
         """
         Updates a given state with a transaction list, making sure that all transactions are valid.
 
         :param state: <dict> State dict.
         :param txn: <list> List of transactions.
+        :param verified: <list> (Optional) verify_transaction result of each transaction if already computed.
         :return: <dict> Updated state.
         """
 
@@ -609,19 +1038,19 @@ class Blockchain:
         state = state.copy()
         
         # If it's only one transaction
-        if isinstance(txn, dict):
+        if isinstance(txn, Transaction):
             txn = [txn]
             
         # Iterate over all transactions
         for i,tx in enumerate(txn):
             
             # Check if it's a valid transaction
-            if Blockchain.is_valid_transaction(state, tx):
+            if Blockchain.is_valid_transaction(state, tx, None if verified is None else verified[i]):
                 
                 # Update the state
-                sender = tx['sender']
-                recipient = tx['recipient']
-                amount = tx['amount']
+                sender = tx.sender
+                recipient = tx.recipient
+                amount = tx.amount
 
                 # If it's a reward transaction, don't subtract from nobody
                 if sender != '0':
@@ -631,40 +1060,218 @@ class Blockchain:
                 state[recipient] = state.get(recipient, 0) + amount
         return state
     
-    def is_full(self):
+    @staticmethod
+    def apply_transaction(state, txn):
         """
-        Checks if the current transaction list has more or equal items as BLOCK_SIZE
+        Moves the amount of an already validated transaction, changing state in place.
+
+        :param state: <dict> State dict.
+        :param txn: <Transaction> Valid transaction.
         """
-        return len(self.current_transactions)>=self.BLOCK_SIZE
+
+        # Reward transactions don't subtract from nobody
+        if txn.sender != '0':
+            state[txn.sender] -= txn.amount
+        state[txn.recipient] = state.get(txn.recipient, 0) + txn.amount
+
+    @staticmethod
+    def apply_block(state, block, verified=None):
+        """
+        Updates a given state with the tokens of a block, keeping what's needed to undo it.
+
+        :param state: <dict> State dict.
+        :param block: <Block> Block.
+        :param verified: <list> (Optional) verify_transaction result of each token if already computed.
+        :return: <tuple> (<dict> Updated state, <dict> Previous balance of each changed address, None if it didn't exist)
+                 or <None> if a token is not valid when it's applied, then the block is not valid.
+        """
+
+        # Unlike update_state no token is skipped, so the proven transactions of a light node are exactly the applied ones
+        new_state = state.copy()
+        touched = set()
+        for i, t in enumerate(block.tokens):
+            if not Blockchain.is_valid_transaction(new_state, t, None if verified is None else verified[i]):
+                return None
+            Blockchain.apply_transaction(new_state, t)
+            touched.add(t.sender)
+            touched.add(t.recipient)
+        undo = {a: state.get(a) for a in touched if state.get(a) != new_state.get(a)}
+        return new_state, undo
+
+    def state_at(self, height):
+        """
+        Computes the state of the chain up to a height (excluded) undoing the blocks after it.
+        If an undo record is missing the state is replayed from the genesis block.
+
+        :param height: <int> Number of blocks.
+        :return: <dict> State, Exception if the replayed chain is not valid.
+        """
+        if height == 0:
+            return {}
+        state = self.state.copy()
+        for n in range(len(self.chain)-1, height-1, -1):
+            undo = self.tx_index.undo(n)
+            if undo is None:
+                print("Missing undo record of block {}, replaying the chain".format(n))
+                state = self.is_valid_chain(self.chain[:height])
+                if state is False:
+                    raise Exception("Invalid chain before block {}".format(height))
+                return state
+            self.revert_block(state, undo)
+        return state
+
+    @staticmethod
+    def revert_block(state, undo):
+        """
+        Undoes a block, changing state in place.
+
+        :param state: <dict> State after the block.
+        :param undo: <dict> Undo record of the block.
+        """
+        for a, v in undo.items():
+            if v is None:
+                state.pop(a, None)
+            else:
+                state[a] = v
+
+    @staticmethod
+    def save_checkpoints(blocks, state, undo):
+        """
+        Saves a checkpoint for each block on a "config.checkpoint_interval" boundary.
+
+        :param blocks: <list> Consecutive blocks.
+        :param state: <dict> State at the end of blocks.
+        :param undo: <list> Undo record of each block.
+        """
+        if not any(b.block_n % config.checkpoint_interval == 0 for b in blocks):
+            return
+        # The state at each block is found undoing the blocks after it, older checkpoints
+        # than the "config.checkpoints_kept" newest ones would be deleted right away
+        state = state.copy()
+        saved = 0
+        for block, u in zip(reversed(blocks), reversed(undo)):
+            if block.block_n % config.checkpoint_interval == 0:
+                save_checkpoint(state, block)
+                saved += 1
+                if saved == config.checkpoints_kept:
+                    return
+            Blockchain.revert_block(state, u)
+
+    def build_template(self, policy=None):
+        """
+        Picks the pending transactions for the block after the last one within the block budgets, see BlockTemplate.
+
+        :param policy: <str> (Optional) Ordering policy, default to config.block_policy.
+        :return: <BlockTemplate> Template with the picked transactions and the signed reward.
+        """
+        st = time.time()
+        with self.chain_lock:
+            parent, state = self.last_block, self.state
+            target = next_target(parent, lambda h: self.chain[h])
+        reward = self.create_reward_transaction(self.wallet)
+        template = BlockTemplate(parent, target, state, self.is_valid_transaction, reward).fill(self.current_transactions.take(), policy)
+        template.build_time = time.time()-st
+        self.metrics.template_built(template.build_time)
+        return template
+
+    def refresh_template(self):
+        """
+        Builds the template of the next block again, transactions that arrive meanwhile are added to the new one.
+
+        :return: <BlockTemplate> New template.
+        """
+        template = self.build_template()
+        with self.chain_lock, self.template_lock:
+            # Another refresh may have finished first on the current tip, then that one is kept
+            tip = self.last_block.hash
+            if self.template is None or template.parent.hash == tip or self.template.parent.hash != tip:
+                self.template = template
+            # Transactions that arrived while it was built
+            for t in self.current_transactions.take():
+                if t.hash not in self.template.tried:
+                    self.template.push(t)
+            return self.template
+
+    def refresh_template_later(self):
+        """
+        Refreshes the template in the background, after a block lands or at startup.
+        """
+        threading.Thread(target=self.refresh_template, daemon=True).start()
+
+    def get_template(self):
+        """
+        :return: <BlockTemplate> Template of the block after the last one, built now only if the ready one is stale.
+        """
+        with self.template_lock:
+            template = self.template
+        if template is None or template.parent.hash != self.last_block.hash:
+            template = self.refresh_template()
+        return template
+
+    def block_from_template(self, template, cancel=None):
+        """
+        Creates the next block from a template, its transactions are already validated so only the PoW is left.
+
+        :param template: <BlockTemplate> Template of the next block.
+        :param cancel: <Cancellation> (Optional) Cancellation of the search, see next_pow.
+        :return: <Block> New Block or <None> if the mining was interrupted.
+        """
+        with self.template_lock:
+            tokens = template.transactions
+            self.template_stats = dict(template.stats(), pending=len(self.current_transactions), build_time=template.build_time)
+        print("Block template: {transactions} transactions, {bytes} bytes, {fullness:.0%} full, skipped {skipped}".format(**self.template_stats))
+        parent = template.parent
+        return self.seal_block(parent.block_n+1, datetime.datetime.now(), tokens, parent.hash, parent.pow, template.target, cancel)
 
     @_mcontroller
     def mine(self):
         """
-        Tries to mine a new block.
+        Tries to mine a new block. If the tip changes meanwhile the search is cancelled
+        and starts again on the new tip.
         
-        :return: <dict> Block dict if it was successful, else False
+        :return: <Block> Block if it was successful, else False
         """
-        self.miningStop = False
-        if not self.is_full():
-            tr = copy.deepcopy(self.current_transactions)
-            self.current_transactions = []
-        else:
-            tr = copy.deepcopy(self.current_transactions[:self.BLOCK_SIZE])
-            self.current_transactions = self.current_transactions[self.BLOCK_SIZE:]
-        nb = self.create_next_block(tr)
-        if nb is not None and self.is_valid_next_block(self.last_block, nb):
-            if self.update_chain(nb):
-                save_transactions(self.current_transactions)
-            return nb
-        else:
-            self.current_transactions = tr+self.current_transactions
-        return False
+        retries = 0
+        while True:
+            # The transactions stay in the pool until the block is added (clean_transactions removes them)
+            template = self.get_template()
+            job = Cancellation()
+            with self.chain_lock:
+                stale_template = template.parent.hash != self.last_block.hash
+                if not stale_template:
+                    self.mining_job = job
+            if stale_template:
+                # The tip changed while getting the template, get_template builds it again on the new one
+                retries += 1
+                if retries > config.template_retries:
+                    print("The tip keeps changing, couldn't get a template to mine on")
+                    return False
+                continue
+            retries = 0
+            nb = self.block_from_template(template, job)
+            with self.chain_lock:
+                if self.mining_job is job:
+                    self.mining_job = None
+
+            if nb is None and not job.is_set():
+                return False
+            if nb is None or nb.previous_hash != self.last_block.hash:
+                # Stale parent, from the tip change until the search stopped
+                stale = time.time()-job.time if job.is_set() else 0.0
+                self.metrics.stale(stale)
+                print("Tip changed, {:.3f}s of stale work on block {}, mining on the new tip".format(stale, template.parent.block_n+1))
+                continue
+            self.metrics.block_found(nb.hash)
+            if self.is_valid_next_block(self.last_block, nb):
+                self.update_chain(nb)
+                return nb
+            return False
         
     @staticmethod
     def retrive_last_block(node):
         url = node+"/chain/last"
         r = requests.get(url)
-        nlb = json.loads(r.text)
+        nlb = Block.from_dict(json.loads(r.text))
         return nlb
 
     @staticmethod
@@ -674,31 +1281,90 @@ class Blockchain:
         return json.loads(r.text)
 
     def clean_transactions(self):
-        state = self.is_valid_chain()
+        # A single copy of the state, the pending transactions are applied to it in place
+        state = self.state.copy()
         hashes = self.get_transaction_hashes()
         for t in self.current_transactions:
-            if t['hash'] in hashes:
-                self.current_transactions.remove(t)
+            if t.hash in hashes:
+                self.current_transactions.remove(t.hash)
             elif self.is_valid_transaction(state,t):
-                state = self.update_state(state,t)
+                self.apply_transaction(state,t)
             else:
-                self.current_transactions.remove(t)
-        save_transactions(self.current_transactions)
+                self.current_transactions.remove(t.hash)
+        self.persist_transactions()
+
+    def block_locator(self):
+        """
+        Hashes of our blocks from the last one back to the genesis block: the 10 last ones one by one,
+        then doubling the step each time. A node finds with it the last block we have in common.
+
+        :return: <list> Block hashes.
+        """
+        heights, step, n = [], 1, len(self.chain)-1
+        while n > 0:
+            heights.append(n)
+            if len(heights) >= 10:
+                step *= 2
+            n -= step
+        heights.append(0)
+        return [self.chain[n].hash for n in heights]
+
+    def find_fork(self, locator):
+        """
+        Finds the last block in common with a node given its block locator.
+
+        :param locator: <list> Block hashes from the node tip back to its genesis block.
+        :return: <int> Number of blocks in common.
+        """
+        for h in locator:
+            n = self.height_of(h)
+            if n is not None:
+                return n+1
+        return 0
+
+    def locate_fork(self, node):
+        """
+        Asks a node for the number of blocks we have in common.
+
+        :param node: <str> Node url.
+        :return: <int> Number of blocks in common.
+        """
+        r = self.broadcaster.post(node, "/chain/locate", data=json.dumps(self.block_locator()))
+        return r.json()['fork']
+
+    def iter_node_chain(self, node, start=0, stop=None):
+        """
+        Streams the blocks of a node, without holding the whole response. Binary records are
+        asked first, nodes that don't support them answer with newline delimited json.
+
+        :param node: <str> Node url.
+        :param start: <int> (Optional) First block number, default to 0.
+        :param stop: <int> (Optional) Last block number (excluded), default to the node chain length.
+        :return: <generator> Blocks.
+        """
+        params = {'start': start}
+        if stop is not None:
+            params['stop'] = stop
+        headers = {"Accept": codec_utils.MIMETYPE+", application/x-ndjson"}
+        r = self.broadcaster.get(node, "/chain", params=params, headers=headers, stream=True)
+        try:
+            if r.headers.get("Content-Type", "").startswith(codec_utils.MIMETYPE):
+                for block in codec_utils.iter_frames(lambda n: r.raw.read(n, decode_content=True)):
+                    yield Block.from_dict(block)
+            else:
+                for line in r.iter_lines():
+                    if line:
+                        yield Block.from_dict(json.loads(line))
+        finally:
+            r.close()
 
-    @staticmethod
-    def retrive_chain(node):
-        url = node+"/chain"
-        r = requests.get(url)
-        chain = json.loads(r.text)
-        return chain
-    
     def get_transaction_hashes(self, chain=None):
         if chain is None:
-            chain = self.chain
+            return self.tx_index.hashes()
         hashes = set()
         for block in chain:
-            for transaction in block['tokens']:
-                hashes.add(transaction['hash'])
+            for transaction in block.tokens:
+                hashes.add(transaction.hash)
         return hashes
 
     def resolve_chains(self):
@@ -708,9 +1374,7 @@ class Blockchain:
         self.resolving_chains = False
 
     def resolve_chain(self, node):
-        state = self.is_valid_chain()
-        
-        if state is False:
+        if not self.valid_chain:
             print("INVALID CURRENT CHAIN!")
 
         try:
@@ -721,40 +1385,62 @@ class Blockchain:
         last_block = self.last_block
         
         # Check if hashes are correct
-        if node_last_block['hash']!=self.hash_block(node_last_block):
+        if node_last_block.hash!=self.hash_block(node_last_block):
             print("Error on node last block")
             return False
-        if last_block['hash']!=self.hash_block(last_block):
+        if last_block.hash!=self.hash_block(last_block):
             print("Error on current chain!")
             return False
         
         print("Last block comparison for chain equality test.")
         # Check if blocks are equal
-        if node_last_block['hash']!=last_block['hash'] or state is False:
+        if node_last_block.hash!=last_block.hash or not self.valid_chain:
             print("Last block comparision differs!!!")
             # If are not equal, we need to check which chain is longer
-            if node_last_block['block_n']>last_block['block_n'] or state is False:
-                print("Chain on {} is longer than ours or we have incorrect one, trying to fetch the full chain.".format(node))
-                # If the node's chain is longer than ours
+            if node_last_block.block_n>last_block.block_n or not self.valid_chain:
+                print("Chain on {} is longer than ours or we have incorrect one, trying to fetch the blocks after the fork.".format(node))
+                # If the node's chain is longer than ours, find the last common block and download only the following ones
                 try:
-                    node_chain = self.retrive_chain(node)
-                    print("Chain recived!")
+                    fork = self.locate_fork(node) if self.valid_chain else 0
                 except Exception as e:
                     print("Error getting {} chain: {}".format(node, str(e)))
                     return False
-                # If the node's chain is correct
-                if self.is_valid_chain(node_chain):
-                    print("The chain is valid.")
-                    # Then we update our chain
-                    self.chain = node_chain
-                    self.miningStop = True
-                    save_chain(self.chain)
-                    self.clean_transactions()
-                    return True
-                else:
+                with self.chain_lock:
+                    if fork > len(self.chain):
+                        return False
+                    parent = self.chain[fork-1] if fork > 0 else None
+                    fork_state = self.state_at(fork)
+
+                # The blocks are validated while they are streamed, without holding the chain lock
+                blocks = []
+                def collect(stream):
+                    for block in stream:
+                        blocks.append(block)
+                        yield block
+                undo = []
+                try:
+                    stream = self.iter_node_chain(node, fork, node_last_block.block_n+1)
+                    node_state = self.is_valid_chain(collect(stream), parent=parent, state=fork_state, undo=undo)
+                except Exception as e:
+                    print("Error getting {} chain: {}".format(node, str(e)))
+                    return False
+                print("Recived {} blocks from block {}".format(len(blocks), fork))
+                if not node_state:
                     # The node chain is invalid
                     print("Invalid chain!")
                     return False
+                with self.chain_lock:
+                    # Our chain may have changed meanwhile
+                    if fork > len(self.chain) or (parent is not None and self.chain[fork-1].hash != parent.hash):
+                        print("Our chain changed while syncing.")
+                        return False
+                    if not (self.has_more_work(fork, blocks) or not self.valid_chain):
+                        print("The node blocks don't have more work than our chain.")
+                        return False
+                    print("The chain is valid.")
+                    # Then we update our chain and the state computed validating it
+                    self.switch_chain(fork, blocks, node_state, undo)
+                    return True
             else:
                 # If our chain is longer
                 print("Our chain is equal or longer.")
@@ -764,46 +1450,89 @@ class Blockchain:
             print("Chains are equal")
             return False
 
-    @staticmethod
-    def get_node_transaction_hashes(node):
-        url = node+"/transactions/hash"
-        r = requests.get(url)
-        hashes = json.loads(r.text)
-        return hashes
+    def get_confirmed_transaction(self, h):
+        """
+        Looks up a confirmed transaction in the transaction index.
+
+        :param h: <str> Transaction hash.
+        :return: <dict> Transaction, block_n, position and confirmations or <None> if it's not confirmed.
+        """
+        entry = self.tx_index.get(h)
+        if entry is None:
+            return None
+        n, position = entry
+        return {
+            'transaction': self.chain[n].tokens[position],
+            'block_n': n,
+            'block_hash': self.chain[n].hash,
+            'position': position,
+            'confirmations': len(self.chain)-n,
+        }
+
+    def get_transaction_proof(self, h):
+        """
+        Builds the Merkle inclusion proof of a confirmed transaction, enough for a light client
+        holding only the block headers to check that the transaction is in the chain.
+
+        :param h: <str> Transaction hash.
+        :return: <dict> Transaction, block_n, position, block header and proof, <None> if it's not
+                 confirmed or <bool> False if its block has no Merkle root (older blocks).
+        """
+        entry = self.tx_index.get(h)
+        if entry is None:
+            return None
+        n, position = entry
+        block = self.chain[n]
+        if block.merkle_root is None:
+            return False
+        return {
+            'transaction': block.tokens[position],
+            'block_n': n,
+            'position': position,
+            'header': block.header(),
+            'proof': merkle_proof([t.leaf for t in block.tokens], position),
+        }
+
+    def get_node_inventory(self, node):
+        """
+        Gets the short ids of the pending transactions of a node.
+
+        :param node: <str> Node url.
+        :return: <list> Short ids.
+        """
+        r = self.broadcaster.get(node, "/transactions/inventory")
+        return r.json()
+
+    def get_node_transactions(self, node, ids):
+        """
+        Gets many pending transactions of a node in a single request.
+
+        :param node: <str> Node url.
+        :param ids: <list> Short ids (or hashes) of the transactions.
+        :return: <list> <Transaction> Transactions.
+        """
+        r = self.broadcaster.post(node, "/transactions/fetch", data=json.dumps(ids))
+        return [Transaction.from_dict(t) for t in r.json()]
 
-    @staticmethod
-    def get_node_transaction(node,hash):
-        url = node+"/transaction/"+hash
-        r = requests.get(url)
-        t = json.loads(r.text)
-        return t
-    
     def resolve_transactions_all(self):
         self.resolving_transactions = True
-        for node in self.nodes:
-            self.resolve_transactions(node)
-        self.resolving_transactions = False
+        try:
+            # Resolve with all the nodes at the same time
+            list(self.broadcaster.executor.map(self.resolve_transactions, list(self.nodes)))
+        finally:
+            self.resolving_transactions = False
 
     def resolve_transactions(self, node):
-        print("="*50)
         print("Starting resolve transactions from",node)
         try:
-            # Get node transaction hashes
-            print("Getting transaction hashes")
-            hashes = self.get_node_transaction_hashes(node)
-            print("Got:",hashes)
-            local_hashes = [t['hash'] for t in self.current_transactions]
-            tdiff = [h for h in hashes if h not in local_hashes]
-            print("Pulling {} transactions".format(len(tdiff)))
-            for h in tdiff:
-                print("Requesting:",h)
-                try:
-                    print("Transaction recived!")
-                    tr = self.get_node_transaction(node,h)
-                    self.update_transaction(tr)
-                except Exception as e:
-                    print("Error requesting transaction:",h)
+            # Compare the node inventory with our pool and fetch all the missing transactions at once
+            ids = self.get_node_inventory(node)
+            missing = [i for i in ids if not self.current_transactions.has_short_id(i)]
+            print("Pulling {} of {} transactions from {}".format(len(missing), len(ids), node))
+            if missing:
+                trs = self.get_node_transactions(node, missing)
+                added = self.update_transactions(trs)
+                print("Added {} transactions from {}".format(sum(added), node))
         except Exception as e:
-            print("Error resolving:",node)
-        print("Ended resolve transactions.")
-        print("="*50)
\ No newline at end of file
+            print("Error resolving {}: {}".format(node, str(e)))
+        print("Ended resolve transactions from",node)
@@ -0,0 +1,133 @@
+from collections import ChainMap, deque
+import config
+
+# Order the pending transactions are tried in, None keeps the pool order (oldest first)
+POLICIES = {
+    'age': None,
+    'amount': lambda t: -t.amount,
+}
+
+class BlockTemplate:
+    """
+    Transactions picked for the block after parent within a byte and a transaction budget (see
+    config.block_max_bytes and config.block_max_transactions), the reward of the miner included.
+    A transaction that doesn't fit, is already picked or overdraws its sender is skipped
+    and the rest of the block is still built. The node keeps one ready and pushes new
+    transactions to it, so mining only has to search the proof of work.
+    """
+
+    def __init__(self, parent, target, state, is_valid, reward, max_bytes=None, max_transactions=None):
+        """
+        :param parent: <Block> Block the new one extends.
+        :param target: <int> Target of the new block.
+        :param state: <dict> Balance state of the chain ending in parent.
+        :param is_valid: <callable> is_valid(state, txn), see Blockchain.is_valid_transaction.
+        :param reward: <Transaction> Reward of the miner, it goes last.
+        :param max_bytes: <int> (Optional) Byte budget, default to config.block_max_bytes.
+        :param max_transactions: <int> (Optional) Transaction budget, default to config.block_max_transactions.
+        """
+        self.max_bytes = config.block_max_bytes if max_bytes is None else max_bytes
+        self.max_transactions = config.block_max_transactions if max_transactions is None else max_transactions
+        self.parent = parent
+        self.target = target
+        self.is_valid = is_valid
+        self.reward = reward
+        self.build_time = None
+        # Balances changed by the picked transactions, over the chain state
+        self.changes = {}
+        self.state = ChainMap(self.changes, state)
+        self.picked = []
+        self.hashes = set()
+        # Hashes of every transaction offered to the template
+        self.tried = set()
+        self.bytes = reward.size
+        self.skipped = {'size': 0, 'conflict': 0, 'invalid': 0}
+
+    @property
+    def transactions(self):
+        """
+        :return: <list> Picked transactions followed by the reward.
+        """
+        return self.picked+[self.reward]
+
+    def is_full(self):
+        return len(self.picked)+1 >= self.max_transactions
+
+    def add(self, txn):
+        """
+        Picks a transaction if it fits and it's valid after the ones already picked.
+
+        :param txn: <Transaction> Pending transaction.
+        :return: <str> 'added', 'size', 'conflict' or 'invalid'.
+        """
+        self.tried.add(txn.hash)
+        if txn.hash in self.hashes or txn.sender == '0':
+            # Rewards only come from the miner
+            return 'conflict'
+        if self.is_full() or self.bytes+txn.size > self.max_bytes:
+            return 'size'
+        if not self.is_valid(self.state, txn):
+            return 'invalid'
+        self.changes[txn.sender] = self.state.get(txn.sender, 0)-txn.amount
+        self.changes[txn.recipient] = self.state.get(txn.recipient, 0)+txn.amount
+        self.picked.append(txn)
+        self.hashes.add(txn.hash)
+        self.bytes += txn.size
+        return 'added'
+
+    def push(self, txn):
+        """
+        Adds a transaction that arrived after the template was built.
+
+        :param txn: <Transaction> Pending transaction.
+        :return: <str> Same as add.
+        """
+        tried = txn.hash in self.tried
+        status = self.add(txn)
+        # Transactions offered before are not counted again
+        if status != 'added' and not tried:
+            self.skipped[status] += 1
+        return status
+
+    def fill(self, pending, policy=None):
+        """
+        Tries the pending transactions in the order of a policy. The ones skipped for lack of funds
+        are tried again right after a picked transaction pays their sender, they can spend what a
+        later transaction receives.
+
+        :param pending: <list> Pending transactions in pool order.
+        :param policy: <str> (Optional) Name in POLICIES, default to config.block_policy.
+        :return: <BlockTemplate> self.
+        """
+        key = POLICIES[config.block_policy if policy is None else policy]
+        queue = deque(pending if key is None else sorted(pending, key=key))
+        # Sender -> its transactions skipped as invalid, waiting for it to receive funds
+        waiting = {}
+        status = {}
+        while queue:
+            txn = queue.popleft()
+            s = self.add(txn)
+            if status.get(txn.hash) != 'added':
+                status[txn.hash] = s
+            if s == 'invalid':
+                waiting.setdefault(txn.sender, []).append(txn)
+            elif s == 'added' and txn.recipient in waiting:
+                queue.extendleft(reversed(waiting.pop(txn.recipient)))
+        for s in status.values():
+            if s != 'added':
+                self.skipped[s] += 1
+        return self
+
+    def stats(self):
+        """
+        :return: <dict> Transactions and bytes used, budgets, fullness (highest of the two ratios) and skipped transactions by reason.
+        """
+        n = len(self.picked)+1
+        return {
+            'transactions': n,
+            'bytes': self.bytes,
+            'max_transactions': self.max_transactions,
+            'max_bytes': self.max_bytes,
+            'fullness': max(n/self.max_transactions, self.bytes/self.max_bytes),
+            'skipped': dict(self.skipped),
+        }
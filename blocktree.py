@@ -0,0 +1,125 @@
+from collections import OrderedDict
+import threading
+import config
+
+class BlockTree:
+    """
+    Blocks known by the node that are not in the main chain, indexed by hash:
+    side branches (blocks whose parent is known) and orphans (blocks whose parent didn't arrive yet).
+    """
+
+    def __init__(self, max_blocks=None, max_orphans=None):
+        self.max_blocks = config.side_pool_size if max_blocks is None else max_blocks
+        self.max_orphans = config.orphan_pool_size if max_orphans is None else max_orphans
+        self.lock = threading.RLock()
+        self.blocks = OrderedDict()
+        self.orphans = OrderedDict()
+        # parent hash -> hashes of the orphans waiting for it
+        self.waiting = {}
+
+    def __contains__(self, h):
+        return h in self.blocks or h in self.orphans
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def get(self, h):
+        """
+        :param h: <str> Block hash.
+        :return: <Block> Side block or <None>.
+        """
+        return self.blocks.get(h)
+
+    def add(self, block):
+        """
+        Adds a side block, dropping the oldest ones if the pool is full.
+
+        :param block: <Block> Block whose parent is known.
+        """
+        with self.lock:
+            self.blocks[block.hash] = block
+            while len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+
+    def remove(self, h):
+        with self.lock:
+            return self.blocks.pop(h, None)
+
+    def add_orphan(self, block):
+        """
+        Adds a block whose parent is unknown, dropping the oldest orphans if the pool is full.
+
+        :param block: <Block> Orphan block.
+        """
+        with self.lock:
+            if block.hash in self.orphans:
+                return
+            self.orphans[block.hash] = block
+            self.waiting.setdefault(block.previous_hash, set()).add(block.hash)
+            while len(self.orphans) > self.max_orphans:
+                _, old = self.orphans.popitem(last=False)
+                self.unwait(old)
+
+    def unwait(self, block):
+        children = self.waiting.get(block.previous_hash)
+        if children is not None:
+            children.discard(block.hash)
+            if not children:
+                del self.waiting[block.previous_hash]
+
+    def pop_orphans(self, parent_hash):
+        """
+        Removes and returns the orphans waiting for a block.
+
+        :param parent_hash: <str> Hash of the block that just arrived.
+        :return: <list> Orphan blocks whose parent is parent_hash.
+        """
+        with self.lock:
+            hashes = self.waiting.pop(parent_hash, set())
+            return [self.orphans.pop(h) for h in hashes if h in self.orphans]
+
+    def branch(self, block, height_of):
+        """
+        Walks back from a side block through its side ancestors until the main chain.
+
+        :param block: <Block> Side block, tip of the branch.
+        :param height_of: <callable> Returns the main chain height of a hash or None.
+        :return: <tuple> (<int> number of main chain blocks before the branch, <list> branch blocks from the fork to block) or <None> if it's not connected.
+        """
+        with self.lock:
+            branch = [block]
+            while True:
+                ph = branch[-1].previous_hash
+                n = height_of(ph)
+                if n is not None:
+                    branch.reverse()
+                    return n+1, branch
+                parent = self.blocks.get(ph)
+                if parent is None:
+                    return None
+                branch.append(parent)
+
+    def orphan_branch(self, block):
+        """
+        Moves a side block and its side ancestors to the orphans, for a branch that lost an
+        ancestor (dropped from a full pool or pruned). They are connected again when it arrives.
+
+        :param block: <Block> Side block, tip of the branch.
+        """
+        with self.lock:
+            while block is not None:
+                self.blocks.pop(block.hash, None)
+                self.add_orphan(block)
+                block = self.blocks.get(block.previous_hash)
+
+    def prune(self, min_height):
+        """
+        Drops the side blocks and orphans below a height, too deep to cause a reorg.
+
+        :param min_height: <int> Minimum block number kept.
+        """
+        with self.lock:
+            for h in [h for h, b in self.blocks.items() if b.block_n < min_height]:
+                del self.blocks[h]
+            for h in [h for h, b in self.orphans.items() if b.block_n < min_height]:
+                self.unwait(self.orphans.pop(h))
@@ -0,0 +1,161 @@
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import threading, time, requests
+import config
+from codec_utils import MIMETYPE
+
+class Broadcaster:
+    """
+    Sends messages to the peers from a bounded pool of threads. Each peer has its own
+    persistent HTTP session, so connections are reused, and every request has a timeout.
+    Latency and failures are recorded per peer, and so are the peers that accept
+    binary records (their responses list MIMETYPE in the Accept-Post header).
+    """
+
+    def __init__(self, workers=None, timeout=None):
+        self.workers = config.broadcast_workers if workers is None else workers
+        self.timeout = config.broadcast_timeout if timeout is None else timeout
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="broadcast")
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.peer_stats = {}
+        self.binary_peers = set()
+
+    def session(self, node):
+        """
+        :param node: <str> Peer url.
+        :return: <requests.Session> Persistent session of the peer.
+        """
+        with self.lock:
+            if node not in self.sessions:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.broadcast_pool_size)
+                s.mount("http://", adapter)
+                s.mount("https://", adapter)
+                self.sessions[node] = s
+            return self.sessions[node]
+
+    def record(self, node, latency, error=None):
+        with self.lock:
+            st = self.peer_stats.setdefault(node, {'requests': 0, 'failures': 0, 'total_latency': 0.0, 'last_latency': None, 'last_error': None})
+            st['requests'] += 1
+            st['total_latency'] += latency
+            st['last_latency'] = latency
+            if error is not None:
+                st['failures'] += 1
+                st['last_error'] = error
+
+    def request(self, method, node, path, **kwargs):
+        """
+        Makes a request to a peer through its session, recording latency and failures.
+
+        :param method: <str> HTTP method.
+        :param node: <str> Peer url.
+        :param path: <str> Path of the endpoint.
+        :return: <requests.Response> Response, exceptions are raised after being recorded.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        st = time.time()
+        try:
+            r = self.session(node).request(method, node+path, **kwargs)
+        except Exception as e:
+            self.record(node, time.time()-st, str(e))
+            raise
+        self.record(node, time.time()-st, None if r.status_code < 500 else "status {}".format(r.status_code))
+        if MIMETYPE in r.headers.get("Accept-Post", ""):
+            self.binary_peers.add(node)
+        return r
+
+    def accepts_binary(self, node):
+        return node in self.binary_peers
+
+    def get(self, node, path, **kwargs):
+        return self.request("GET", node, path, **kwargs)
+
+    def post(self, node, path, **kwargs):
+        return self.request("POST", node, path, **kwargs)
+
+    def send(self, node, path, data, headers=None):
+        try:
+            r = self.post(node, path, data=data, headers=headers)
+            print("Sent {} to {}, status: {}".format(path, node, r.status_code))
+            return r
+        except Exception as e:
+            print("Error sending {} to {}: {}".format(path, node, str(e)))
+            return None
+
+    def broadcast(self, nodes, path, data, headers=None, binary=None):
+        """
+        Posts the same data to every peer concurrently, without waiting for the responses.
+
+        :param nodes: <list> Peers urls.
+        :param path: <str> Path of the endpoint.
+        :param data: <str> Body of the request.
+        :param headers: <dict> (Optional) Headers of the request.
+        :param binary: <bytes> (Optional) Binary record of the same data, sent to the peers that accept it.
+        :return: <list> Futures with the response of each peer (<None> if the request failed).
+        """
+        binary_headers = dict(headers or {}, **{"Content-Type": MIMETYPE})
+        futures = []
+        for node in list(nodes):
+            if binary is not None and self.accepts_binary(node):
+                futures.append(self.executor.submit(self.send, node, path, binary, binary_headers))
+            else:
+                futures.append(self.executor.submit(self.send, node, path, data, headers))
+        return futures
+
+    def stats(self):
+        """
+        :return: <dict> Requests, failures and latency (seconds) of every peer.
+        """
+        with self.lock:
+            resp = {}
+            for node, st in self.peer_stats.items():
+                st = dict(st)
+                st['avg_latency'] = st['total_latency']/st['requests'] if st['requests'] else None
+                del st['total_latency']
+                resp[node] = st
+            return resp
+
+class TransactionBatcher:
+    """
+    Collects outgoing transactions and hands them to a send function as a single batch
+    when config.batch_size transactions are waiting or config.batch_window seconds
+    passed since the first one.
+    """
+
+    def __init__(self, send, size=None, window=None):
+        self.send = send
+        self.size = config.batch_size if size is None else size
+        self.window = config.batch_window if window is None else window
+        self.lock = threading.Lock()
+        self.pending = []
+        self.timer = None
+
+    def add(self, txn):
+        """
+        Queues a transaction.
+
+        :param txn: <dict> Transaction to send.
+        """
+        with self.lock:
+            self.pending.append(txn)
+            full = len(self.pending) >= self.size
+            if not full and self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends the queued transactions now.
+        """
+        with self.lock:
+            batch, self.pending = self.pending, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if batch:
+            self.send(batch)
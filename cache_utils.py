@@ -0,0 +1,64 @@
+from collections import OrderedDict
+import threading
+
+class LRUCache:
+    """
+    Bounded dict evicting the least recently used keys, it counts hits and misses.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        """
+        Gets a value and marks the key as recently used.
+
+        :param key: <any> Key to look up.
+        :param default: <any> (Optional) Returned if the key is not cached.
+        :return: <any> Cached value or default.
+        """
+        with self.lock:
+            if key in self.data:
+                self.hits += 1
+                self.data.move_to_end(key)
+                return self.data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value=True):
+        """
+        Adds a value, evicting the least recently used keys if the cache is full.
+
+        :param key: <any> Key.
+        :param value: <any> (Optional) Value, default to True.
+        """
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        """
+        :return: <dict> Size and hit/miss counters of the cache.
+        """
+        with self.lock:
+            total = self.hits+self.misses
+            return {
+                'size': len(self.data),
+                'max_size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits/total if total else 0.0,
+            }
@@ -1,32 +1,314 @@
 from pathlib import Path
-import json, config
+import json, zlib, config
+from store_utils import BlockStore
+from cache_utils import LRUCache
+from codec_utils import frame
+from transaction_utils import Transaction
+from utils import Record, hash_fields
+from merkle_utils import merkle_root
+import sys
+
+_store = None
+
+class Block(Record):
+    """
+    Immutable block, its tokens are kept as a tuple of transactions.
+    Blocks with a 'merkle_root' commit to their tokens through it and only the header
+    (every field but 'tokens' and 'hash') is hashed. Older blocks hash every field but 'hash'.
+    Newer blocks also have the 'target' their proof of work meets (see pow_utils.next_target).
+    """
+
+    __slots__ = FIELDS = ('block_n', 'timestamp', 'token_n', 'tokens', 'miner', 'previous_hash', 'pow', 'merkle_root', 'target', 'hash')
+    OPTIONAL = ('merkle_root', 'target')
+    HASH_EXCLUDE = ("hash",)
+
+    def __init__(self, **fields):
+        if 'tokens' in fields:
+            fields['tokens'] = tuple(Transaction.from_dict(t) for t in fields['tokens'])
+        if type(fields.get('miner')) is str:
+            fields['miner'] = sys.intern(fields['miner'])
+        super().__init__(**fields)
+
+    def to_dict(self):
+        d = super().to_dict()
+        d['tokens'] = [t.to_dict() for t in self.tokens]
+        return d
+
+    def header(self):
+        """
+        :return: <dict> Json shape of the block without its tokens.
+        """
+        d = super().to_dict()
+        del d['tokens']
+        return d
+
+    def compute_digest(self):
+        if self.merkle_root is None:
+            return super().compute_digest()
+        return hash_fields(self.header(), self.HASH_EXCLUDE)
+
+    def has_valid_body(self):
+        """
+        :return: <bool> True if the tokens match the header (token_n and merkle_root).
+        """
+        if self.merkle_root is None:
+            return True
+        return self.token_n == len(self.tokens) and self.merkle_root == merkle_root([t.leaf for t in self.tokens])
+
+class StoredChain:
+    """
+    Chain read from the block store when it's used instead of being decoded at once. Blocks are
+    decoded on access and the "config.chain_cache_size" most recently used ones are kept.
+    It can be read like a list of blocks (len, indexes, slices, iteration), appending and replacing
+    blocks writes them to the store.
+    """
+
+    def __init__(self, store, cache_size=None):
+        self.store = store
+        # hash -> Block, hashes never change meaning so a reorg doesn't need to clear it
+        self.cache = LRUCache(config.chain_cache_size if cache_size is None else cache_size)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            start, stop, step = n.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return self.blocks(start, stop)
+        with self.store.lock:
+            if n < 0:
+                n += len(self.store)
+            if not 0 <= n < len(self.store):
+                raise IndexError("Block {} out of range".format(n))
+            h = self.store.hash_at(n)
+            block = self.cache.get(h)
+            if block is None:
+                block = Block.from_dict(self.store.get(n))
+                self.cache.put(h, block)
+            return block
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+    def blocks(self, start=0, stop=None):
+        """
+        Reads the blocks in [start, stop), each segment is opened once. Blocks not cached
+        aren't added, so a long read doesn't evict the recent ones.
+
+        :param start: <int> (Optional) First block number, default to 0.
+        :param stop: <int> (Optional) Block number where to stop (excluded), default to the chain length.
+        :return: <list> Blocks.
+        """
+        with self.store.lock:
+            stop = len(self.store) if stop is None else min(stop, len(self.store))
+            blocks = []
+            for n, data in enumerate(self.store.iter_blocks(start, stop), start):
+                block = self.cache.get(self.store.hash_at(n))
+                blocks.append(Block.from_dict(data) if block is None else block)
+            return blocks
+
+    def append(self, block):
+        """
+        :param block: <Block> Block to add at the end of the chain.
+        """
+        self.store.append(block)
+        self.cache.put(block.hash, block)
+
+    def replace(self, height, blocks):
+        """
+        Replaces the blocks from height (included) to the end.
+
+        :param height: <int> Number of blocks kept.
+        :param blocks: <list> New blocks after them.
+        """
+        with self.store.lock:
+            self.store.truncate(height)
+            for block in blocks:
+                self.append(block)
+
+def get_store():
+    """
+    Returns the block store in "config.blocks_dir", opening it the first time.
+
+    :return: <BlockStore> Block store.
+    """
+
+    global _store
+    if _store is None or _store.path != Path(config.blocks_dir):
+        _store = BlockStore()
+    return _store
 
 def save_chain(chain):
     """
-    Saves a given chain to "config.chain_path".
+    Saves a given chain to the block store in "config.blocks_dir".
+    Only the blocks that differ from the stored ones are written.
 
     :param chain: <list> Chain to save.
     :return: <pathlib.Path> Path where it was saved.
     """
 
-    p = Path(config.chain_path)
-    p.write_text(json.dumps(chain, sort_keys=True))
-    print("Chain saved to",p)
-    return p
+    store = get_store()
+    store.sync(chain)
+    print("Chain saved to",store.path)
+    return store.path
 
 def load_chain(path=None):
     """
-    Reads a chain in "path" but if the file does not exist return a empty chain
+    Reads the chain from the block store. If the store is empty and a "config.chain_path"
+    json file exists (old format) it's imported into the store.
 
-    :param path: <str> (Optional) Path of the file where the chain is saved.
-    :return: <list> Chain.
+    :param path: <str> (Optional) Path of a json file where the chain is saved.
+    :return: <StoredChain> Chain, or <list> if it's read from path.
     """
 
-    if path is None:
-        p = Path(config.chain_path)
-        if not p.exists():
-            return []
+    if path is not None:
+        return [Block.from_dict(b) for b in json.loads(Path(path).read_text())]
+
+    store = get_store()
+    p = Path(config.chain_path)
+    if len(store)==0 and p.exists():
+        print("Importing",p,"to",store.path)
+        store.sync([Block.from_dict(b) for b in json.loads(p.read_text())])
+    return StoredChain(store)
+
+def iter_chain_json(chain, start=0, stop=None, ndjson=False, headers=False):
+    """
+    Serializes the blocks of a chain one by one, so the whole chain is never a single string.
+
+    :param chain: <list> Chain.
+    :param start: <int> (Optional) First block number, default to 0.
+    :param stop: <int> (Optional) Last block number (excluded), default to the chain length.
+    :param ndjson: <bool> (Optional) Newline delimited blocks instead of a json list, default to False.
+    :param headers: <bool> (Optional) Only the block headers, default to False.
+    :return: <generator> Chunks of text.
+    """
+
+    if stop is None:
+        stop = len(chain)
+    if not ndjson:
+        yield "["
+    for n in range(start, stop):
+        block = json.dumps(chain[n].header() if headers else chain[n].to_dict(), sort_keys=True)
+        if ndjson:
+            yield block+"\n"
         else:
-            return json.loads(p.read_text())
-    else:
-        return json.loads(Path(path).read_text())
\ No newline at end of file
+            yield block if n == start else ","+block
+    if not ndjson:
+        yield "]"
+
+def iter_chain_binary(chain, start=0, stop=None):
+    """
+    Serializes the blocks of a chain one by one as length prefixed binary records.
+
+    :param chain: <list> Chain.
+    :param start: <int> (Optional) First block number, default to 0.
+    :param stop: <int> (Optional) Last block number (excluded), default to the chain length.
+    :return: <generator> Chunks of bytes.
+    """
+
+    if stop is None:
+        stop = len(chain)
+    for n in range(start, stop):
+        yield frame(chain[n].to_dict())
+
+def gzip_stream(chunks):
+    """
+    Compresses a stream of text or bytes chunks with gzip.
+
+    :param chunks: <iterable> Chunks of text or bytes.
+    :return: <generator> Chunks of gzip data.
+    """
+
+    z = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = z.compress(chunk if isinstance(chunk, bytes) else chunk.encode())
+        if data:
+            yield data
+    yield z.flush()
+
+
+def save_state(state, block):
+    """
+    Saves the balance state of the chain ending in "block" to "config.state_path".
+
+    :param state: <dict> Balance state.
+    :param block: <Block> Last block applied to the state.
+    :return: <pathlib.Path> Path where it was saved.
+    """
+
+    p = Path(config.state_path)
+    data = {
+        'block_n': block.block_n,
+        'hash': block.hash,
+        'balances': state,
+    }
+    p.write_text(json.dumps(data, sort_keys=True))
+    return p
+
+def load_state():
+    """
+    Reads the saved balance state if the file exists.
+
+    :return: <dict> Dict with the 'block_n' and 'hash' of the last applied block and the 'balances', or <None>.
+    """
+
+    p = Path(config.state_path)
+    if not p.exists():
+        return None
+    try:
+        return json.loads(p.read_text())
+    except ValueError:
+        print("State file corrupted")
+        return None
+
+def save_checkpoint(state, block):
+    """
+    Saves a checkpoint of the balance state at "block" to "config.checkpoints_dir",
+    keeping only the "config.checkpoints_kept" newest ones.
+
+    :param state: <dict> Balance state.
+    :param block: <Block> Last block applied to the state.
+    :return: <pathlib.Path> Path where it was saved.
+    """
+
+    d = Path(config.checkpoints_dir)
+    d.mkdir(parents=True, exist_ok=True)
+    data = {
+        'block_n': block.block_n,
+        'hash': block.hash,
+        'balances': state,
+    }
+    p = d/"{}.json".format(block.block_n)
+    # Write and rename, so a checkpoint file is never partially written
+    tmp = p.with_suffix(".tmp")
+    tmp.write_text(json.dumps(data, sort_keys=True))
+    tmp.replace(p)
+    for old in checkpoint_paths()[config.checkpoints_kept:]:
+        old.unlink()
+    return p
+
+def checkpoint_paths():
+    """
+    :return: <list> Paths of the saved checkpoints, newest first.
+    """
+
+    d = Path(config.checkpoints_dir)
+    if not d.exists():
+        return []
+    return sorted((p for p in d.glob("*.json") if p.stem.isdigit()), key=lambda p: int(p.stem), reverse=True)
+
+def load_checkpoints():
+    """
+    Reads the saved checkpoints, newest first. Unreadable ones are skipped.
+
+    :return: <generator> Dicts with the 'block_n' and 'hash' of the last applied block and the 'balances'.
+    """
+
+    for p in checkpoint_paths():
+        try:
+            yield json.loads(p.read_text())
+        except ValueError:
+            print("Checkpoint",p,"corrupted")
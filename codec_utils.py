@@ -0,0 +1,277 @@
+"""
+Compact binary encoding of blocks and transactions.
+
+A record is MAGIC + version byte + one encoded value. Values are tagged:
+known field names are written as a small id, hex strings (hashes, keys, signatures)
+as raw bytes, base58 addresses decoded, iso timestamps as microseconds and numbers
+as varints or doubles. Dict keys are sorted like json.dumps(sort_keys=True), so
+every value has a single (canonical) encoding and decoding gives back the same dict.
+Hashes are still computed over the json form, the codec is only for storage and transfer.
+"""
+import datetime, struct, json, functools
+import base58
+
+MIMETYPE = "application/x-bchain"
+
+MAGIC = b"\xbc"
+VERSION = 1
+
+# Field ids, only append to this list: the position is the id on the wire
+FIELDS = [
+    'block_n', 'timestamp', 'token_n', 'tokens', 'miner', 'previous_hash', 'pow', 'hash',
+    'sender', 'recipient', 'amount', 'public_key', 'signature', 'merkle_root', 'target',
+]
+FIELD_IDS = {f: i+1 for i, f in enumerate(FIELDS)}
+
+T_NONE, T_FALSE, T_TRUE, T_INT, T_FLOAT, T_STR, T_HEX, T_B58, T_TIME, T_LIST, T_DICT = range(11)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+DOUBLE = struct.Struct(">d")
+
+def write_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def read_varint(data, pos):
+    n = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+def zigzag(n):
+    return n*2 if n >= 0 else -n*2-1
+
+def unzigzag(n):
+    return n >> 1 if not n & 1 else -(n >> 1)-1
+
+def is_hex(s):
+    try:
+        return len(s) > 0 and bytes.fromhex(s).hex() == s
+    except ValueError:
+        return False
+
+# Addresses repeat a lot and base58 is slow, remember the latest ones
+@functools.lru_cache(maxsize=4096)
+def as_base58(s):
+    # Only strings that come back equal from bytes are stored decoded
+    try:
+        raw = base58.b58decode(s)
+    except ValueError:
+        return None
+    return raw if base58.b58encode(raw).decode() == s else None
+
+@functools.lru_cache(maxsize=4096)
+def from_base58(raw):
+    return base58.b58encode(raw).decode()
+
+def as_micros(s):
+    try:
+        dt = datetime.datetime.fromisoformat(s)
+    except ValueError:
+        return None
+    if dt.tzinfo is not None or dt.isoformat() != s:
+        return None
+    return (dt-EPOCH)//MICROSECOND
+
+def write_bytes(out, tag, raw):
+    out.append(tag)
+    write_varint(out, len(raw))
+    out += raw
+
+def write_value(out, v):
+    if v is None:
+        out.append(T_NONE)
+    elif v is True:
+        out.append(T_TRUE)
+    elif v is False:
+        out.append(T_FALSE)
+    elif isinstance(v, int):
+        out.append(T_INT)
+        write_varint(out, zigzag(v))
+    elif isinstance(v, float):
+        out.append(T_FLOAT)
+        out += DOUBLE.pack(v)
+    elif isinstance(v, str):
+        if is_hex(v):
+            write_bytes(out, T_HEX, bytes.fromhex(v))
+            return
+        micros = as_micros(v) if len(v) >= 19 else None
+        if micros is not None:
+            out.append(T_TIME)
+            write_varint(out, zigzag(micros))
+            return
+        raw = as_base58(v) if len(v) >= 25 else None
+        if raw is not None:
+            write_bytes(out, T_B58, raw)
+        else:
+            write_bytes(out, T_STR, v.encode())
+    elif isinstance(v, (list, tuple)):
+        out.append(T_LIST)
+        write_varint(out, len(v))
+        for item in v:
+            write_value(out, item)
+    elif isinstance(v, dict):
+        out.append(T_DICT)
+        write_varint(out, len(v))
+        for k in sorted(v):
+            fid = FIELD_IDS.get(k)
+            if fid is None:
+                out.append(0)
+                raw = k.encode()
+                write_varint(out, len(raw))
+                out += raw
+            else:
+                write_varint(out, fid)
+            write_value(out, v[k])
+    else:
+        raise TypeError("Can't encode {}".format(type(v).__name__))
+
+def read_bytes(data, pos):
+    n, pos = read_varint(data, pos)
+    if pos+n > len(data):
+        raise ValueError("Truncated record")
+    return bytes(data[pos:pos+n]), pos+n
+
+def read_value(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == T_NONE:
+        return None, pos
+    if tag == T_TRUE:
+        return True, pos
+    if tag == T_FALSE:
+        return False, pos
+    if tag == T_INT:
+        n, pos = read_varint(data, pos)
+        return unzigzag(n), pos
+    if tag == T_FLOAT:
+        return DOUBLE.unpack_from(data, pos)[0], pos+DOUBLE.size
+    if tag == T_STR:
+        raw, pos = read_bytes(data, pos)
+        return raw.decode(), pos
+    if tag == T_HEX:
+        raw, pos = read_bytes(data, pos)
+        return raw.hex(), pos
+    if tag == T_B58:
+        raw, pos = read_bytes(data, pos)
+        return from_base58(raw), pos
+    if tag == T_TIME:
+        n, pos = read_varint(data, pos)
+        return (EPOCH+unzigzag(n)*MICROSECOND).isoformat(), pos
+    if tag == T_LIST:
+        n, pos = read_varint(data, pos)
+        items = []
+        for _ in range(n):
+            item, pos = read_value(data, pos)
+            items.append(item)
+        return items, pos
+    if tag == T_DICT:
+        n, pos = read_varint(data, pos)
+        d = {}
+        for _ in range(n):
+            fid, pos = read_varint(data, pos)
+            if fid == 0:
+                raw, pos = read_bytes(data, pos)
+                k = raw.decode()
+            else:
+                k = FIELDS[fid-1]
+            d[k], pos = read_value(data, pos)
+        return d, pos
+    raise ValueError("Unknown tag {}".format(tag))
+
+def encode(obj):
+    """
+    Encodes a block, transaction or any json-like value.
+
+    :param obj: <dict> Value to encode.
+    :return: <bytes> Binary record.
+    """
+
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    write_value(out, obj)
+    return bytes(out)
+
+def decode(data):
+    """
+    Decodes a binary record.
+
+    :param data: <bytes> Binary record.
+    :return: <dict> Decoded value, ValueError if the record is malformed.
+    """
+
+    if data[:1] != MAGIC:
+        raise ValueError("Not a binary record")
+    if data[1:2] != bytes([VERSION]):
+        raise ValueError("Unknown codec version {}".format(data[1:2].hex()))
+    try:
+        obj, pos = read_value(data, 2)
+    except (IndexError, struct.error, OverflowError, RecursionError) as e:
+        # Truncated or corrupted record, like a bad record from a peer
+        raise ValueError("Malformed record: {}".format(e))
+    if pos != len(data):
+        raise ValueError("Trailing data after record")
+    return obj
+
+def loads(data):
+    """
+    Decodes a record that can be either binary or json.
+
+    :param data: <bytes> Record.
+    :return: <dict> Decoded value.
+    """
+
+    if data[:1] == MAGIC:
+        return decode(data)
+    return json.loads(data)
+
+def frame(obj):
+    """
+    Encodes a value prefixed with its length, to send many records in a stream.
+
+    :param obj: <dict> Value to encode.
+    :return: <bytes> Length prefixed record.
+    """
+
+    data = encode(obj)
+    out = bytearray()
+    write_varint(out, len(data))
+    return bytes(out)+data
+
+def iter_frames(read):
+    """
+    Reads length prefixed records from a stream.
+
+    :param read: <callable> Returns up to n bytes of the stream, empty at the end.
+    :return: <generator> Decoded values, ValueError if the stream is malformed.
+    """
+
+    def read_exact(n):
+        buf = b""
+        while len(buf) < n:
+            chunk = read(n-len(buf))
+            if not chunk:
+                raise ValueError("Truncated stream")
+            buf += chunk
+        return buf
+
+    while True:
+        first = read(1)
+        if not first:
+            return
+        n = shift = 0
+        b = first[0]
+        while True:
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+            b = read_exact(1)[0]
+        yield decode(read_exact(n))
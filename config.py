@@ -3,6 +3,7 @@
 """
 Configuration file to keep all config together
 """
+import os
 
 # Wallet defaults
 
@@ -16,10 +17,105 @@ wallet_namef = "wallet-{}.dat"
 
 chain_path = "chain.json"
 
+blocks_dir = "blocks"
+
+segment_size = 16*1024*1024
+
+# "json" or "binary" (codec_utils), stores can mix both. Json decodes faster at startup,
+# the binary encoding is smaller and stays the one used on the wire
+store_encoding = "json"
+
+validation_window = 64
+
+# Decoded blocks of the chain kept in memory, the others are read from the store when used
+chain_cache_size = 2000
+
+side_pool_size = 1000
+
+orphan_pool_size = 100
+
+max_reorg_depth = 100
+
+state_path = "state.json"
+
+# A checkpoint of the state is saved every checkpoint_interval blocks
+checkpoints_dir = "checkpoints"
+
+checkpoint_interval = 1000
+
+checkpoints_kept = 3
+
+txindex_path = "txindex.jsonl"
+
+# Light node defaults
+
+headers_path = "headers.jsonl"
+
+watch_path = "watch.json"
+
 # Transactions defaults
 
 transactions_path = "unconfirmed_transactions.json"
 
+mempool_size = 50000
+
+mempool_save_delay = 1.0
+
+short_id_length = 16
+
+# Validation defaults
+
+validation_workers = os.cpu_count() or 1
+
+verified_cache_size = 100000
+
 #nodes defaults
 
 max_nodes = 8
+
+broadcast_workers = 16
+
+broadcast_pool_size = 4
+
+broadcast_timeout = 5.0
+
+batch_size = 500
+
+batch_window = 0.2
+
+# Mining defaults
+
+# Budget of the transactions of a block (the reward included), bytes of their binary records
+block_max_bytes = 1000000
+
+block_max_transactions = 4000
+
+# Order the pending transactions are picked in: "age" (oldest first) or "amount" (largest first)
+block_policy = "age"
+
+# Leading zero bits of the initial target (genesis block and blocks without target)
+pow_bits = 24
+
+# Easiest target the retarget can reach
+min_pow_bits = 8
+
+# Seconds between blocks the target aims for
+block_interval = 60
+
+# Blocks between two retargets
+retarget_interval = 20
+
+# A block timestamp must be later than the median of the last median_time_blocks blocks
+median_time_blocks = 11
+
+# and at most max_future_time seconds ahead of the node clock
+max_future_time = 2*60*60
+
+mining_workers = os.cpu_count() or 1
+
+mining_check_interval = 10000
+
+# Times the miner gets the template again when the tip changes meanwhile, before giving up
+template_retries = 5
+
+mining_start_method = "fork"
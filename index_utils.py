@@ -0,0 +1,168 @@
+from pathlib import Path
+import json, threading
+import config
+
+class TransactionIndex:
+    """
+    Index of the confirmed transactions: hash -> (block_n, position in the block tokens),
+    and address -> positions of the transactions it sent or received.
+    It's saved as an append-only json lines file with one [block_n, block hash, tx hashes, undo, addresses]
+    line per block, addresses being the [sender, recipient] of each transaction.
+    The undo record keeps the balances the block changed as they were before it (None if the
+    address didn't exist), so the state can be moved back to any height without a replay.
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(config.txindex_path if path is None else path)
+        self.lock = threading.RLock()
+        self.entries = {}
+        # address -> [(block_n, position)]
+        self.addresses = {}
+        # height -> (block hash, tx hashes, undo record, end of its line in the file, [sender, recipient] of each tx)
+        self.blocks = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, h):
+        return h in self.entries
+
+    def get(self, h):
+        """
+        :param h: <str> Transaction hash.
+        :return: <tuple> (block_n, position) of the transaction or <None> if it's not confirmed.
+        """
+        return self.entries.get(h)
+
+    def address_transactions(self, address, start=0):
+        """
+        :param address: <str> Wallet address.
+        :param start: <int> (Optional) First block number, default to 0.
+        :return: <list> (hash, block_n, position) of the confirmed transactions sent or received by address.
+        """
+        with self.lock:
+            return [(self.blocks[n][1][pos], n, pos) for n, pos in self.addresses.get(address, ()) if n >= start]
+
+    def hashes(self):
+        """
+        :return: <dict_keys> Hashes of all the confirmed transactions.
+        """
+        return self.entries.keys()
+
+    def load(self):
+        """
+        Reads the index file, a partially written last line is dropped and so are the lines
+        written before the address index existed (sync adds them again from the chain).
+
+        :return: <bool> True if the file existed.
+        """
+
+        if not self.path.exists():
+            return False
+        with self.lock, self.path.open("rb") as f:
+            end = 0
+            for line in f:
+                try:
+                    n, bh, hashes, undo, addresses = json.loads(line)
+                except ValueError:
+                    break
+                if n != len(self.blocks) or not line.endswith(b"\n"):
+                    break
+                end += len(line)
+                self.index(n, bh, hashes, undo, end, addresses)
+        self.rollback(len(self.blocks))
+        return True
+
+    def index(self, n, block_hash, hashes, undo, end, addresses):
+        # Keep the first block where a hash appears
+        for pos, h in enumerate(hashes):
+            self.entries.setdefault(h, (n, pos))
+        for pos, pair in enumerate(addresses):
+            for a in set(pair):
+                self.addresses.setdefault(a, []).append((n, pos))
+        self.blocks.append((block_hash, hashes, undo, end, addresses))
+
+    def undo(self, n):
+        """
+        :param n: <int> Block number.
+        :return: <dict> Undo record of the block or <None> if it's unknown.
+        """
+        return self.blocks[n][2]
+
+    def add_block(self, block, undo=None):
+        """
+        Indexes the transactions of the block following the last indexed one.
+
+        :param block: <Block> Block.
+        :param undo: <dict> (Optional) Undo record of the block.
+        """
+
+        with self.lock:
+            if block.block_n != len(self.blocks):
+                raise ValueError("Block {} can't be indexed at height {}".format(block.block_n, len(self.blocks)))
+            hashes = [t.hash for t in block.tokens]
+            addresses = [[t.sender, t.recipient] for t in block.tokens]
+            line = (json.dumps([block.block_n, block.hash, hashes, undo, addresses])+"\n").encode()
+            with self.path.open("ab") as f:
+                f.write(line)
+            self.index(block.block_n, block.hash, hashes, undo, self.end()+len(line), addresses)
+
+    def end(self):
+        return self.blocks[-1][3] if self.blocks else 0
+
+    def rollback(self, height):
+        """
+        Removes the transactions of the blocks from height (included) to the end.
+
+        :param height: <int> Number of blocks to keep.
+        """
+
+        with self.lock:
+            for n in range(len(self.blocks)-1, height-1, -1):
+                for h in self.blocks[n][1]:
+                    # Don't remove a hash that was also in an earlier block
+                    if h in self.entries and self.entries[h][0] >= n:
+                        del self.entries[h]
+                for a in set(a for pair in self.blocks[n][4] for a in pair):
+                    positions = self.addresses[a]
+                    while positions and positions[-1][0] >= n:
+                        positions.pop()
+                    if not positions:
+                        del self.addresses[a]
+            del self.blocks[height:]
+            if self.path.exists() and self.path.stat().st_size > self.end():
+                with self.path.open("r+b") as f:
+                    f.truncate(self.end())
+
+    def sync(self, chain, apply_block=None):
+        """
+        Makes the index match a chain: rolls back the blocks after the common prefix and indexes the rest.
+        With apply_block the undo records are computed too, blocks indexed without one are indexed again
+        and the chain is replayed up to the first block indexed.
+
+        :param chain: <list> Chain.
+        :param apply_block: <callable> (Optional) apply_block(state, block) returns (state, undo record) or None if the
+                            block is not valid, see Blockchain.apply_block. The blocks after an invalid one get no undo record.
+        """
+
+        with self.lock:
+            i = min(len(self.blocks), len(chain))
+            while i > 0 and self.blocks[i-1][0] != chain[i-1].hash:
+                i -= 1
+            if apply_block is not None:
+                i = next((n for n in range(i) if self.blocks[n][2] is None), i)
+            if i < len(self.blocks):
+                self.rollback(i)
+            if i == len(chain):
+                return
+            state = None if apply_block is None else {}
+            for block in chain[:i]:
+                if state is not None:
+                    applied = apply_block(state, block)
+                    state = None if applied is None else applied[0]
+            for block in chain[i:]:
+                undo = None
+                if state is not None:
+                    applied = apply_block(state, block)
+                    state, undo = (None, None) if applied is None else applied
+                self.add_block(block, undo)
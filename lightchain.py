@@ -0,0 +1,303 @@
+from pathlib import Path
+from broadcast_utils import Broadcaster
+from chain_utils import Block
+from transaction_utils import Transaction
+from merkle_utils import verify_merkle_proof
+from pow_utils import is_valid_proof, is_valid_target, is_valid_timestamp, block_target, block_work
+from utils import load_data, save_data, hash_fields
+import json, threading
+import config
+
+class LightChain:
+    """
+    Light node: keeps only the block headers, checking their hash and PoW linkage, and the
+    transactions of the watched addresses. Those are fetched from full nodes with a Merkle
+    inclusion proof checked against our headers (or, for blocks without Merkle root, with
+    the block body checked against its header hash).
+    """
+
+    def __init__(self, uid, port=5000):
+        self.port = port
+        self.node_uid = uid
+        self.nodes = load_data("nodes.json", [])
+        self.broadcaster = Broadcaster()
+        self.lock = threading.RLock()
+        self.headers_path = Path(config.headers_path)
+        self.headers = []
+        self.load_headers()
+        self.watched = load_data(config.watch_path, [])
+        # address -> {tx hash: {'transaction', 'block_n', 'position'}} checked against our headers
+        self.transactions = {a: {} for a in self.watched}
+        self.resolving_chains = False
+
+    def load_headers(self):
+        """
+        Reads the saved headers, stopping at the first one that doesn't follow the previous.
+        """
+        if not self.headers_path.exists():
+            return
+        with self.headers_path.open() as f:
+            for line in f:
+                try:
+                    header = json.loads(line)
+                except ValueError:
+                    break
+                parent = self.headers[-1] if self.headers else None
+                if not self.is_valid_header(parent, header, lambda h: self.headers[h]):
+                    break
+                self.headers.append(header)
+        print("Loaded {} headers".format(len(self.headers)))
+
+    def save_headers(self, start=0):
+        """
+        Writes the headers from start to the end of the file.
+
+        :param start: <int> (Optional) First header to write, the previous ones are kept, default to 0.
+        """
+        lines = [json.dumps(h, sort_keys=True)+"\n" for h in self.headers[start:]]
+        if start == 0 or not self.headers_path.exists():
+            self.headers_path.write_text("".join(lines))
+            return
+        # Keep the first start lines and replace the rest
+        with self.headers_path.open("r+") as f:
+            for _ in range(start):
+                f.readline()
+            f.truncate(f.tell())
+            f.write("".join(lines))
+
+    def truncate(self, height):
+        """
+        Drops the headers from height (included) and the watched transactions in them.
+
+        :param height: <int> Number of headers to keep.
+        """
+        del self.headers[height:]
+        for txs in self.transactions.values():
+            for h in [h for h, t in txs.items() if t['block_n'] >= height]:
+                del txs[h]
+
+    @staticmethod
+    def is_valid_header(parent, header, ancestor):
+        """
+        Checks a header against its parent: number, previous hash, timestamp, target, PoW and its own hash.
+        Blocks without Merkle root hash their tokens too, so only their linkage can be checked.
+
+        :param parent: <dict> Previous header or <None> for the genesis block.
+        :param header: <dict> Header to check.
+        :param ancestor: <callable> Returns the header at a given height of the chain of parent.
+        :return: <bool> True if it's valid.
+        """
+        if 'merkle_root' in header and header['hash'] != hash_fields(header, Block.HASH_EXCLUDE):
+            return False
+        if not is_valid_timestamp(parent, header, ancestor) or not is_valid_target(parent, header, ancestor):
+            return False
+        if parent is None:
+            return header['block_n'] == 0
+        return (header['block_n'] == parent['block_n']+1 and header['previous_hash'] == parent['hash']
+                and is_valid_proof(parent['pow'], parent['hash'], header['pow'], block_target(header)))
+
+    def block_locator(self):
+        """
+        :return: <list> Hashes of our headers from the last one back, see Blockchain.block_locator.
+        """
+        heights, step, n = [], 1, len(self.headers)-1
+        while n > 0:
+            heights.append(n)
+            if len(heights) >= 10:
+                step *= 2
+            n -= step
+        if self.headers:
+            heights.append(0)
+        return [self.headers[n]['hash'] for n in heights]
+
+    def iter_node_headers(self, node, start):
+        """
+        Streams the headers of a node from start.
+
+        :param node: <str> Node url.
+        :param start: <int> First block number.
+        :return: <generator> Headers.
+        """
+        r = self.broadcaster.get(node, "/chain/headers", params={'start': start, 'format': 'ndjson'}, stream=True)
+        try:
+            for line in r.iter_lines():
+                if line:
+                    yield json.loads(line)
+        finally:
+            r.close()
+
+    def sync_headers(self, node):
+        """
+        Downloads the headers of a node after the last one in common and switches to them
+        if they are valid and have more work than ours.
+
+        :param node: <str> Node url.
+        :return: <bool> True if our headers changed.
+        """
+        try:
+            r = self.broadcaster.post(node, "/chain/locate", data=json.dumps(self.block_locator()))
+            fork = r.json()['fork']
+            with self.lock:
+                parent = self.headers[fork-1] if fork > 0 else None
+            new = []
+            ancestor = lambda h: new[h-fork] if h >= fork else self.headers[h]
+            for header in self.iter_node_headers(node, fork):
+                if not self.is_valid_header(new[-1] if new else parent, header, ancestor):
+                    print("Invalid header {} from {}".format(header.get('block_n'), node))
+                    return False
+                new.append(header)
+        except Exception as e:
+            print("Error getting {} headers: {}".format(node, str(e)))
+            return False
+
+        with self.lock:
+            # Our headers may have changed meanwhile
+            if fork > len(self.headers) or (parent is not None and self.headers[fork-1]['hash'] != parent['hash']):
+                return False
+            if sum(block_work(h) for h in new) <= sum(block_work(h) for h in self.headers[fork:]):
+                return False
+            self.truncate(fork)
+            for header in new:
+                self.headers.append(header)
+            self.save_headers(fork)
+        print("Synced {} headers from {}, height {}".format(len(new), node, len(self.headers)))
+        return True
+
+    def watch(self, address):
+        """
+        Adds an address to the watch list.
+
+        :param address: <str> Wallet address.
+        :return: <bool> False if it was already watched.
+        """
+        with self.lock:
+            if address in self.watched:
+                return False
+            self.watched.append(address)
+            self.transactions[address] = {}
+            save_data(self.watched, config.watch_path)
+            return True
+
+    def verify_proof(self, proof):
+        """
+        Checks a transaction inclusion proof (as served by /transaction/<hash>/proof) against our headers.
+
+        :param proof: <dict> Transaction, block_n, position, header and Merkle path.
+        :return: <Transaction> The transaction if the proof is valid, otherwise <None>.
+        """
+        n = proof['block_n']
+        if n >= len(self.headers) or proof['header'] != self.headers[n]:
+            return None
+        tx = Transaction.from_dict(proof['transaction'])
+        if tx.hash != tx.digest or not verify_merkle_proof(tx.leaf, proof['proof'], self.headers[n]['merkle_root']):
+            return None
+        return tx
+
+    def fetch_block(self, node, n):
+        """
+        Downloads a block body and checks it against our header (blocks without Merkle root).
+
+        :param node: <str> Node url.
+        :param n: <int> Block number.
+        :return: <Block> Block if it matches our header, otherwise <None>.
+        """
+        r = self.broadcaster.get(node, "/chain", params={'start': n, 'stop': n+1})
+        blocks = r.json()
+        if len(blocks) != 1:
+            return None
+        block = Block.from_dict(blocks[0])
+        if n >= len(self.headers) or block.hash != self.headers[n]['hash'] or block.digest != block.hash or not block.has_valid_body():
+            return None
+        return block
+
+    def sync_address(self, node, address):
+        """
+        Fetches the confirmed transactions of a watched address from a node, keeping those proven to be in our headers.
+
+        :param node: <str> Node url.
+        :param address: <str> Wallet address.
+        :return: <int> Number of new transactions.
+        """
+        r = self.broadcaster.get(node, "/address/{}/transactions".format(address))
+        added = 0
+        blocks = {}
+        for entry in r.json():
+            h, n, position = entry['hash'], entry['block_n'], entry['position']
+            if h in self.transactions[address] or n >= len(self.headers):
+                continue
+            if 'merkle_root' in self.headers[n]:
+                p = self.broadcaster.get(node, "/transaction/{}/proof".format(h))
+                tx = self.verify_proof(p.json()) if p.status_code == 200 else None
+            else:
+                if n not in blocks:
+                    blocks[n] = self.fetch_block(node, n)
+                block = blocks[n]
+                tx = block.tokens[position] if block is not None and position < len(block.tokens) else None
+            if tx is None or tx.hash != h or address not in (tx.sender, tx.recipient):
+                print("Couldn't prove transaction {} from {}".format(h, node))
+                continue
+            with self.lock:
+                self.transactions[address][h] = {'transaction': tx, 'block_n': n, 'position': position}
+            added += 1
+        return added
+
+    def resolve_chains(self):
+        """
+        Syncs the headers with every node and then the transactions of the watched addresses.
+        """
+        self.resolving_chains = True
+        try:
+            for node in list(self.nodes):
+                self.sync_headers(node)
+            for node in list(self.nodes):
+                for address in list(self.watched):
+                    try:
+                        self.sync_address(node, address)
+                    except Exception as e:
+                        print("Error getting {} transactions from {}: {}".format(address, node, str(e)))
+        finally:
+            self.resolving_chains = False
+
+    def balance(self, address):
+        """
+        Balance of a watched address from its proven transactions. Blocks with a transaction that
+        is not valid (bad signature, overdraws its sender) are not valid (see Blockchain.apply_block),
+        so every proven transaction was applied by the full nodes.
+
+        :param address: <str> Wallet address.
+        :return: <dict> Balance, transactions and confirmations of each one.
+        """
+        with self.lock:
+            txs = sorted(self.transactions.get(address, {}).values(), key=lambda t: (t['block_n'], t['position']))
+            balance = 0
+            for t in txs:
+                tx = t['transaction']
+                if tx.recipient == address:
+                    balance += tx.amount
+                if tx.sender == address:
+                    balance -= tx.amount
+            return {
+                'address': address,
+                'balance': balance,
+                'height': len(self.headers),
+                'transactions': [dict(t, transaction=t['transaction'].to_dict(), confirmations=len(self.headers)-t['block_n']) for t in txs],
+            }
+
+    def add_node(self, node):
+        """
+        Adds a full node to get the headers and proofs from.
+
+        :param node: <str> Node url.
+        :return: <bool> True if it was added.
+        """
+        if node in self.nodes:
+            return False
+        try:
+            if self.broadcaster.get(node, "/uid").text == self.node_uid:
+                return False
+        except Exception as e:
+            print("Couldn't retrive {} uid".format(node))
+            return False
+        self.nodes.append(node)
+        save_data(self.nodes, "nodes.json")
+        return True
@@ -0,0 +1,156 @@
+from collections import OrderedDict
+import threading
+import config
+
+class Mempool:
+    """
+    Pool of pending transactions indexed by hash and kept in insertion order.
+    It also indexes the transactions by sender, keeping the amount they reserve,
+    and by short id (first config.short_id_length characters of the hash) for the inventory sync.
+    """
+
+    def __init__(self, transactions=(), capacity=None):
+        self.capacity = capacity
+        self.transactions = OrderedDict()
+        self.short_ids = {}
+        self.by_sender = {}
+        self.reserved = {}
+        self.lock = threading.RLock()
+        for t in transactions:
+            self.add(t)
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __iter__(self):
+        # Iterate over a snapshot so the pool can change meanwhile
+        return iter(self.to_list())
+
+    def __contains__(self, h):
+        return h in self.transactions
+
+    def get(self, h):
+        """
+        :param h: <str> Transaction hash.
+        :return: <Transaction> Pending transaction or <None>.
+        """
+        return self.transactions.get(h)
+
+    def add(self, txn):
+        """
+        Adds a transaction, evicting the oldest ones if the pool is full.
+
+        :param txn: <Transaction> Transaction to add.
+        :return: <bool> False if the transaction was already in the pool.
+        """
+
+        with self.lock:
+            h = txn.hash
+            if h in self.transactions:
+                return False
+            while self.capacity is not None and len(self.transactions) >= self.capacity:
+                oldest = next(iter(self.transactions))
+                print("Mempool full, evicting:",oldest)
+                self.remove(oldest)
+
+            self.transactions[h] = txn
+            self.short_ids[self.short_id(h)] = h
+            sender = txn.sender
+            self.by_sender.setdefault(sender, OrderedDict())[h] = txn
+            if sender != '0':
+                self.reserved[sender] = self.reserved.get(sender, 0) + txn.amount
+            return True
+
+    def remove(self, h):
+        """
+        Removes a transaction.
+
+        :param h: <str> Transaction hash.
+        :return: <Transaction> Removed transaction or <None> if it was not in the pool.
+        """
+
+        with self.lock:
+            txn = self.transactions.pop(h, None)
+            if txn is None:
+                return None
+            if self.short_ids.get(self.short_id(h)) == h:
+                del self.short_ids[self.short_id(h)]
+            sender = txn.sender
+            pending = self.by_sender[sender]
+            del pending[h]
+            if not pending:
+                del self.by_sender[sender]
+            if sender != '0':
+                self.reserved[sender] -= txn.amount
+                if sender not in self.by_sender:
+                    del self.reserved[sender]
+            return txn
+
+    @staticmethod
+    def short_id(h):
+        """
+        :param h: <str> Transaction hash.
+        :return: <str> Short id of the transaction.
+        """
+        return h[:config.short_id_length]
+
+    def has_short_id(self, i):
+        return i[:config.short_id_length] in self.short_ids
+
+    def get_many(self, ids):
+        """
+        Gets the transactions given their short ids or hashes.
+
+        :param ids: <list> Short ids or hashes.
+        :return: <list> Pending transactions found.
+        """
+        with self.lock:
+            hashes = (self.short_ids.get(i[:config.short_id_length]) for i in ids)
+            return [self.transactions[h] for h in hashes if h is not None]
+
+    def inventory(self):
+        """
+        :return: <list> Short ids of the pending transactions in insertion order.
+        """
+        with self.lock:
+            return [self.short_id(h) for h in self.transactions]
+
+    def reserved_by(self, sender):
+        """
+        :param sender: <str> Sender address.
+        :return: <float> Amount reserved by the pending transactions of sender.
+        """
+        return self.reserved.get(sender, 0)
+
+    def sender_transactions(self, sender):
+        """
+        :param sender: <str> Sender address.
+        :return: <list> Pending transactions of sender in insertion order.
+        """
+        with self.lock:
+            return list(self.by_sender.get(sender, {}).values())
+
+    def take(self, n=None):
+        """
+        Gets the n oldest transactions without removing them.
+
+        :param n: <int> (Optional) Number of transactions, default to all.
+        :return: <list> Transactions.
+        """
+        with self.lock:
+            if n is None:
+                return list(self.transactions.values())
+            return [t for t, _ in zip(self.transactions.values(), range(n))]
+
+    def hashes(self):
+        """
+        :return: <list> Hashes of the pending transactions in insertion order.
+        """
+        with self.lock:
+            return list(self.transactions)
+
+    def to_list(self):
+        """
+        :return: <list> Pending transactions in insertion order.
+        """
+        return self.take()
@@ -0,0 +1,69 @@
+"""
+Merkle tree of the tokens of a block. Leaves and inner nodes are hashed with a different
+prefix byte, and the last node of an odd level is moved up as it is (not duplicated),
+so two different token lists can't have the same root.
+"""
+import hashlib
+
+EMPTY_ROOT = hashlib.sha256(b"").hexdigest()
+
+def merkle_leaf(data):
+    """
+    :param data: <bytes> Serialized token.
+    :return: <str> Leaf hash.
+    """
+    return hashlib.sha256(b"\x00"+data).hexdigest()
+
+def merkle_node(left, right):
+    return hashlib.sha256(b"\x01"+bytes.fromhex(left)+bytes.fromhex(right)).hexdigest()
+
+def merkle_levels(leaves):
+    """
+    :param leaves: <list> Leaf hashes.
+    :return: <list> Levels of the tree, from the leaves to the root.
+    """
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        up = [merkle_node(level[i], level[i+1]) for i in range(0, len(level)-1, 2)]
+        if len(level) % 2:
+            up.append(level[-1])
+        levels.append(up)
+    return levels
+
+def merkle_root(leaves):
+    """
+    :param leaves: <list> Leaf hashes.
+    :return: <str> Root hash.
+    """
+    if not leaves:
+        return EMPTY_ROOT
+    return merkle_levels(leaves)[-1][0]
+
+def merkle_proof(leaves, index):
+    """
+    Builds the inclusion proof of a leaf.
+
+    :param leaves: <list> Leaf hashes.
+    :param index: <int> Position of the leaf.
+    :return: <list> [side, hash] of every sibling from the leaf up, side is 'L' if the sibling is on the left.
+    """
+    proof = []
+    for level in merkle_levels(leaves)[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(['L' if sibling < index else 'R', level[sibling]])
+        index //= 2
+    return proof
+
+def verify_merkle_proof(leaf, proof, root):
+    """
+    :param leaf: <str> Leaf hash.
+    :param proof: <list> Proof as returned by merkle_proof.
+    :param root: <str> Merkle root of the block header.
+    :return: <bool> True if the leaf is in the tree with that root.
+    """
+    h = leaf
+    for side, sibling in proof:
+        h = merkle_node(sibling, h) if side == 'L' else merkle_node(h, sibling)
+    return h == root
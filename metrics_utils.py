@@ -0,0 +1,130 @@
+from collections import OrderedDict, deque
+import threading, time
+
+class MiningMetrics:
+    """
+    Counters and timings of the miner: nonces tried, hashrate, time to solution, interrupted
+    attempts, stale work after a tip change, template build time and the delay from finding
+    a block to a peer accepting it. Timings keep the last "window" values.
+    """
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.attempts = 0
+        self.found = 0
+        self.interrupted = 0
+        self.failed = 0
+        self.nonces = 0
+        self.search_time = 0.0
+        # (start time, nonces tried) of the running search
+        self.search = None
+        self.last_hashrate = None
+        self.solution_times = deque(maxlen=window)
+        self.template_times = deque(maxlen=window)
+        self.stale_times = deque(maxlen=window)
+        self.accept_times = deque(maxlen=window)
+        # Hash -> time it was found, of our blocks not accepted by a peer yet
+        self.found_at = OrderedDict()
+        self.window = window
+
+    def start_search(self):
+        with self.lock:
+            self.attempts += 1
+            self.search = (time.time(), 0)
+
+    def progress(self, nonces):
+        """
+        :param nonces: <int> Nonces tried so far by the running search.
+        """
+        with self.lock:
+            if self.search is not None:
+                self.search = (self.search[0], nonces)
+
+    def end_search(self, result):
+        """
+        :param result: <str> 'found', 'interrupted' or 'failed'.
+        """
+        with self.lock:
+            if self.search is None:
+                return
+            start, nonces = self.search
+            self.search = None
+            elapsed = time.time()-start
+            self.nonces += nonces
+            self.search_time += elapsed
+            if elapsed > 0:
+                self.last_hashrate = nonces/elapsed
+            if result == 'found':
+                self.found += 1
+                self.solution_times.append(elapsed)
+            elif result == 'interrupted':
+                self.interrupted += 1
+            else:
+                self.failed += 1
+
+    def template_built(self, seconds):
+        with self.lock:
+            self.template_times.append(seconds)
+
+    def stale(self, seconds):
+        """
+        :param seconds: <float> Time the miner kept working on a parent that was no longer the tip.
+        """
+        with self.lock:
+            self.stale_times.append(seconds)
+
+    def block_found(self, h):
+        with self.lock:
+            self.found_at[h] = time.time()
+            while len(self.found_at) > self.window:
+                self.found_at.popitem(last=False)
+
+    def block_accepted(self, h):
+        """
+        Records the delay from finding a block to the first peer accepting it.
+
+        :param h: <str> Block hash, blocks we didn't find are ignored.
+        """
+        with self.lock:
+            found = self.found_at.pop(h, None)
+            if found is not None:
+                self.accept_times.append(time.time()-found)
+
+    @staticmethod
+    def summary(values):
+        values = list(values)
+        return {
+            'count': len(values),
+            'last': values[-1] if values else None,
+            'avg': sum(values)/len(values) if values else None,
+            'max': max(values) if values else None,
+        }
+
+    def stats(self):
+        """
+        :return: <dict> Current and average hashrate (nonces per second), counters and timings (seconds).
+        """
+        with self.lock:
+            nonces, search_time, current = self.nonces, self.search_time, self.last_hashrate
+            if self.search is not None:
+                start, tried = self.search
+                elapsed = time.time()-start
+                nonces += tried
+                search_time += elapsed
+                if elapsed > 0:
+                    current = tried/elapsed
+            return {
+                'mining': self.search is not None,
+                'hashrate': current,
+                'avg_hashrate': nonces/search_time if search_time else None,
+                'nonces': nonces,
+                'search_time': search_time,
+                'attempts': self.attempts,
+                'found': self.found,
+                'interrupted': self.interrupted,
+                'failed': self.failed,
+                'time_to_solution': self.summary(self.solution_times),
+                'stale_work': self.summary(self.stale_times),
+                'template_build_time': self.summary(self.template_times),
+                'found_to_accepted': self.summary(self.accept_times),
+            }
@@ -0,0 +1,331 @@
+import hashlib, multiprocessing, queue, datetime, threading, time
+import config
+
+def bits_to_target(bits):
+    """
+    :param bits: <int> Number of leading zero bits.
+    :return: <int> Target a digest must be below to start with that many zero bits.
+    """
+    return 2**(256-bits)
+
+def initial_target():
+    """
+    :return: <int> Target of the genesis block and of the blocks without a target field (older blocks), from config.pow_bits.
+    """
+    return bits_to_target(config.pow_bits)
+
+def max_target():
+    """
+    :return: <int> Easiest target a retarget can reach, from config.min_pow_bits.
+    """
+    return bits_to_target(config.min_pow_bits)
+
+def field(block, name):
+    # Blocks can be Block objects or header dicts (light nodes)
+    return block.get(name) if isinstance(block, dict) else getattr(block, name)
+
+def block_target(block):
+    """
+    :param block: <Block> Block or header dict.
+    :return: <int> Target its proof has to meet.
+    """
+    target = field(block, 'target')
+    return initial_target() if target is None else target
+
+def is_valid_proof(last_proof, last_hash, proof, target=None):
+    """
+    Checks if the proof of work it's correct.
+
+    :param last_proof: <int> The value of the PoW of the previous block
+    :param last_hash: <str> The String representation of the hash of the previous block.
+    :param proof: <int> Proof to check.
+    :param target: <int> (Optional) The hash, as a number, must be below it, default to initial_target().
+    :return: <bool> True if the proof is valid.
+    """
+    if target is None:
+        target = initial_target()
+    guess = f'{last_proof}{last_hash}{proof}'.encode()
+    return int.from_bytes(hashlib.sha256(guess).digest(), "big") < target
+
+def block_work(block):
+    """
+    Expected number of hashes needed to find the proof of a block.
+
+    :param block: <Block> Block or header dict.
+    :return: <int> Work of the block.
+    """
+    return 2**256//block_target(block)
+
+def retarget(target, timespan):
+    """
+    Scales a target by the time the last config.retarget_interval blocks took against the
+    expected time. The change is limited to 4 times up or down.
+
+    :param target: <int> Current target.
+    :param timespan: <int> Seconds between the first and the last block of the interval.
+    :return: <int> New target.
+    """
+    # Integers only, every node must get the same target
+    expected = config.block_interval*(config.retarget_interval-1)
+    timespan = min(max(timespan, expected//4), expected*4)
+    return max(1, min(target*timespan//expected, max_target()))
+
+def parse_timestamp(value):
+    """
+    :param value: <str> Block timestamp, a naive iso datetime.
+    :return: <datetime.datetime> Timestamp or <None> if it's not a naive iso datetime.
+    """
+    if not isinstance(value, str):
+        return None
+    try:
+        t = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    # Aware and naive datetimes can't be compared
+    return t if t.tzinfo is None else None
+
+def block_time(block):
+    """
+    :param block: <Block> Block or header dict.
+    :return: <datetime.datetime> Timestamp of the block, ValueError if it's not valid.
+    """
+    t = parse_timestamp(field(block, 'timestamp'))
+    if t is None:
+        raise ValueError("Invalid timestamp {!r}".format(field(block, 'timestamp')))
+    return t
+
+def median_time(parent, ancestor):
+    """
+    :param parent: <Block> Block or header dict.
+    :param ancestor: <callable> Returns the block at a given height of the chain of parent.
+    :return: <datetime.datetime> Median timestamp of parent and the blocks before it, config.median_time_blocks in total.
+    """
+    n = field(parent, 'block_n')
+    times = [block_time(ancestor(h)) for h in range(max(0, n+1-config.median_time_blocks), n)]
+    times.append(block_time(parent))
+    times.sort()
+    return times[len(times)//2]
+
+def is_valid_timestamp(parent, block, ancestor, now=None):
+    """
+    Checks the timestamp of a block: a naive iso datetime later than the median of the last
+    config.median_time_blocks blocks and at most config.max_future_time seconds after now.
+    It keeps miners from moving the timestamps the retarget is computed from.
+
+    :param parent: <Block> Previous block or header dict, <None> for the genesis block.
+    :param block: <Block> Block or header dict.
+    :param ancestor: <callable> Returns the block at a given height of the chain of parent.
+    :param now: <datetime.datetime> (Optional) Current time, default to datetime.now().
+    :return: <bool> True if the timestamp is valid.
+    """
+    t = parse_timestamp(field(block, 'timestamp'))
+    if t is None:
+        return False
+    if now is None:
+        now = datetime.datetime.now()
+    if t > now+datetime.timedelta(seconds=config.max_future_time):
+        return False
+    if parent is None:
+        return True
+    try:
+        return t > median_time(parent, ancestor)
+    except ValueError:
+        return False
+
+def next_target(parent, ancestor):
+    """
+    Target of the block after parent. It's the parent's target except every config.retarget_interval
+    blocks, when it's retargeted from the timestamps of the last interval.
+
+    :param parent: <Block> Previous block or header dict.
+    :param ancestor: <callable> Returns the block at a given height of the chain of parent.
+    :return: <int> Target, ValueError if a timestamp it's computed from is not valid.
+    """
+    n = field(parent, 'block_n')+1
+    target = block_target(parent)
+    if n % config.retarget_interval or n < config.retarget_interval:
+        return target
+    first = ancestor(n-config.retarget_interval)
+    timespan = block_time(parent)-block_time(first)
+    return retarget(target, int(timespan.total_seconds()))
+
+def is_valid_target(parent, block, ancestor):
+    """
+    Checks the target of a block. Blocks without a target field (older blocks) are only valid
+    after blocks without it, so once a chain has targets they can't be left out.
+
+    :param parent: <Block> Previous block or header dict, <None> for the genesis block.
+    :param block: <Block> Block or header dict.
+    :param ancestor: <callable> Returns the block at a given height of the chain of parent.
+    :return: <bool> True if it's the expected target.
+    """
+    target = field(block, 'target')
+    if parent is None:
+        return target is None or target == initial_target()
+    if target is None:
+        return field(parent, 'target') is None
+    try:
+        return target == next_target(parent, ancestor)
+    except ValueError:
+        return False
+
+class ProofEngine:
+    """
+    Proof of work engine for a fixed parent block. The '{last_proof}{last_hash}' prefix is
+    hashed once and the hash state is cloned for every nonce.
+    """
+
+    def __init__(self, last_proof, last_hash, target=None):
+        if target is None:
+            target = initial_target()
+        self.target = target
+        self.prefix = hashlib.sha256(f'{last_proof}{last_hash}'.encode())
+
+        # Digests are compared as big endian bytes, the same order as the numbers
+        self.limit = (min(target, 2**256)-1).to_bytes(32, "big")
+
+    def is_valid(self, proof):
+        """
+        Checks a single proof.
+
+        :param proof: <int> Proof to check.
+        :return: <bool> True if the proof is valid.
+        """
+        h = self.prefix.copy()
+        h.update(str(proof).encode())
+        return h.digest() <= self.limit
+
+    def search(self, start, stop, step=1):
+        """
+        Tests a batch of nonces: range(start, stop, step).
+
+        :param start: <int> First nonce.
+        :param stop: <int> End of the batch (excluded).
+        :param step: <int> (Optional) Distance between two nonces, default to 1.
+        :return: <int> First valid proof of the batch or <None> if there is none.
+        """
+
+        # Bind everything to locals, this is the hot loop
+        copy, limit = self.prefix.copy, self.limit
+        for proof in range(start, stop, step):
+            h = copy()
+            h.update(str(proof).encode())
+            if h.digest() <= limit:
+                return proof
+        return None
+
+class Cancellation:
+    """
+    Cancels a proof of work search from any thread. The search registers callbacks (like
+    setting the stop event of its worker processes) that run as soon as it's cancelled,
+    so nothing waits for a poll.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.time = None
+
+    def cancel(self):
+        """
+        :return: <bool> False if it was already cancelled.
+        """
+        with self.lock:
+            if self.event.is_set():
+                return False
+            self.time = time.time()
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+        return True
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def on_cancel(self, callback):
+        """
+        Registers a callback, it runs right away if it was already cancelled.
+
+        :param callback: <callable> Function without arguments.
+        """
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+def search_proof(last_proof, last_hash, target, start, step, stop, found, tried):
+    """
+    Worker loop of the parallel search. Tests the nonces start, start+step, start+2*step...
+    until a valid proof is found or the stop event is set.
+
+    :param last_proof: <int> PoW of the last block
+    :param last_hash: <str> String representation of the hash of the last block
+    :param target: <int> Target of the new block.
+    :param start: <int> First nonce tested by this worker.
+    :param step: <int> Distance between two nonces of this worker (number of workers).
+    :param stop: <multiprocessing.Event> Event shared by all the workers of the search.
+    :param found: <multiprocessing.Queue> Queue where the valid proof is put.
+    :param tried: <multiprocessing.Value> Nonces tried by all the workers.
+    """
+
+    engine = ProofEngine(last_proof, last_hash, target)
+    batch = config.mining_check_interval*step
+    while not stop.is_set():
+        # Only look at the stop event once per batch
+        proof = engine.search(start, start+batch, step)
+        with tried.get_lock():
+            # A found proof ends the batch early
+            tried.value += config.mining_check_interval if proof is None else (proof-start)//step+1
+        if proof is not None:
+            found.put(proof)
+            stop.set()
+            return
+        start += batch
+
+def parallel_pow(last_proof, last_hash, target, workers, cancel, progress=None, poll=0.5):
+    """
+    Searches the next proof of work splitting the nonce space across a pool of worker processes.
+    The first valid proof stops all the workers.
+
+    :param last_proof: <int> PoW of the last block
+    :param last_hash: <str> String representation of the hash of the last block
+    :param target: <int> Target of the new block.
+    :param workers: <int> Number of worker processes.
+    :param cancel: <Cancellation> Cancels the search, the workers stop at the end of their current batch.
+    :param progress: <callable> (Optional) Called with the nonces tried so far after every poll.
+    :param poll: <float> (Optional) Seconds between two checks that the workers are alive, default to 0.5.
+    :return: <int> Valid PoW or <None> if the search was cancelled.
+    """
+
+    # Fork, so the workers don't re-import the main module (server.py)
+    ctx = multiprocessing.get_context(config.mining_start_method)
+    stop = ctx.Event()
+    found = ctx.Queue()
+    tried = ctx.Value('Q', 0)
+    procs = [ctx.Process(target=search_proof, args=(last_proof, last_hash, target, i, workers, stop, found, tried), daemon=True) for i in range(workers)]
+    for p in procs:
+        p.start()
+
+    # On cancel stop the workers and wake up this thread with a None proof
+    cancel.on_cancel(stop.set)
+    cancel.on_cancel(lambda: found.put(None))
+    proof = None
+    try:
+        while proof is None and not cancel.is_set():
+            try:
+                proof = found.get(timeout=poll)
+            except queue.Empty:
+                if not any(p.is_alive() for p in procs) and found.empty():
+                    raise Exception("Mining workers died")
+            if progress is not None:
+                progress(tried.value)
+    finally:
+        stop.set()
+        for p in procs:
+            p.join()
+        if progress is not None:
+            progress(tried.value)
+    return proof
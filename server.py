@@ -1,11 +1,16 @@
 import hashlib, json, time, uuid, argparse
-from flask import Flask, jsonify, request, render_template
+from flask import Flask, jsonify, request, render_template, Response, stream_with_context
 from blockchain import Blockchain
+from lightchain import LightChain
 from wallet_utils import create_wallet, save_wallet
+from chain_utils import iter_chain_json, iter_chain_binary, gzip_stream, Block
+from transaction_utils import Transaction
+import codec_utils
 import threading
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-p","--port",default=5000, type=int, help="Port to run node on")
+parser.add_argument("--light",action="store_true", help="Run a light node (headers and watched addresses only)")
 args = parser.parse_args()
 
 # Instantiate our node
@@ -15,7 +20,38 @@ app = Flask(__name__)
 node_identifier = str(uuid.uuid4()).replace("-","")
 
 # Instantiate Blockchain
-blockchain = Blockchain(port=args.port, uid=node_identifier)
+if args.light:
+    blockchain = LightChain(port=args.port, uid=node_identifier)
+else:
+    blockchain = Blockchain(port=args.port, uid=node_identifier)
+
+# Endpoints a light node serves, the rest need the full chain
+LIGHT_ENDPOINTS = {"get_uid", "get_nodes", "nodes_stats", "add_node", "light_sync", "light_watch", "light_address", "light_headers", "static"}
+
+# Endpoints only a light node serves
+LIGHT_ONLY_ENDPOINTS = {"light_sync", "light_watch", "light_address", "light_headers"}
+
+def read_body():
+    """
+    Decodes the body of the request, binary records if the Content-Type says so, json otherwise.
+    """
+    data = request.get_data()
+    if request.mimetype == codec_utils.MIMETYPE:
+        return codec_utils.decode(data)
+    return json.loads(data.decode())
+
+@app.before_request
+def light_only():
+    if args.light and request.endpoint not in LIGHT_ENDPOINTS:
+        return jsonify({"error":"Not available on a light node"}), 404
+    if not args.light and request.endpoint in LIGHT_ONLY_ENDPOINTS:
+        return jsonify({"error":"Only available on a light node"}), 404
+
+@app.after_request
+def accept_post(response):
+    # Tell the peers they can post binary records to this node
+    response.headers["Accept-Post"] = "application/json, "+codec_utils.MIMETYPE
+    return response
 
 
 @app.route("/mine",methods=['GET'])
@@ -62,18 +98,41 @@ def add_transaction():
     """
     Adds a new transaction to the current_transactions list if valid throught a POST request.
     """
-    tr = json.loads(request.get_data().decode())
-    print("Adding transaction:",tr['hash'])
-    state = blockchain.is_valid_chain()
-    state = blockchain.update_state(state, blockchain.current_transactions)
-    if blockchain.is_valid_transaction(state,tr):
+    try:
+        tr = Transaction.from_dict(read_body())
+    except ValueError as e:
+        print("Couldn't add. Invalid transaction:",str(e))
+        return jsonify(False), 401
+    print("Adding transaction:",tr.hash)
+    if blockchain.is_valid_pending_transaction(tr):
         blockchain.update_transaction(tr)
-        print("Added transaction:",tr['hash'])
-        return jsonify(tr['hash']), 201
+        print("Added transaction:",tr.hash)
+        return jsonify(tr.hash), 201
     else:
-        print("Couldn't add. Invalid transaction:",tr['hash'])
+        print("Couldn't add. Invalid transaction:",tr.hash)
         return jsonify(False), 401
 
+@app.route("/transactions/add/batch",methods=['POST'])
+def add_transactions():
+    """
+    Adds a batch of transactions through a POST request, all of them are validated against the same state.
+    """
+    trs, rejected = [], []
+    for t in read_body():
+        try:
+            trs.append(Transaction.from_dict(t))
+        except ValueError:
+            rejected.append(t.get('hash') if isinstance(t, dict) else None)
+    added = blockchain.update_transactions(trs)
+    print("Added {} of {} transactions".format(sum(added), len(trs)+len(rejected)))
+
+    # Create response
+    resp = {
+        "accepted": [t.hash for t, a in zip(trs, added) if a],
+        "rejected": rejected+[t.hash for t, a in zip(trs, added) if not a],
+    }
+    return jsonify(resp), 201
+
 @app.route("/transactions/new",methods=['POST'])
 def new_transaction():
     """
@@ -101,11 +160,8 @@ def new_transaction():
         # Create transaction
         t = blockchain.create_transaction(wallet, recipient, amount)
         
-        # Compute state
-        state = blockchain.is_valid_chain()
-        state = blockchain.update_state(state, blockchain.current_transactions)
-        # Check transaction validity
-        if blockchain.is_valid_transaction(state, t):
+        # Check transaction validity against the state and the reserved funds
+        if blockchain.is_valid_pending_transaction(t):
             blockchain.update_transaction(t)
             msg = "Done"
         else:
@@ -128,20 +184,35 @@ def transactions():
     GET request to view all pending transactions.
     """
 
-    return jsonify(blockchain.current_transactions), 200
+    return jsonify([t.to_dict() for t in blockchain.current_transactions]), 200
 
 @app.route("/transactions/hash",methods=['GET'])
 def get_transaction_hash():
     """
     GET request to view all pending transactions hash in a list.
     """
-    # Get state
-    state = blockchain.is_valid_chain()
     # Get all transactions hash
-    hashes = [t['hash'] for t in blockchain.current_transactions]
+    hashes = blockchain.current_transactions.hashes()
 
     return jsonify(hashes), 200
 
+@app.route("/transactions/inventory",methods=['GET'])
+def transactions_inventory():
+    """
+    GET request to view the short ids of all pending transactions, used to find the missing ones.
+    """
+
+    return jsonify(blockchain.current_transactions.inventory()), 200
+
+@app.route("/transactions/fetch",methods=['POST'])
+def fetch_transactions():
+    """
+    POST request to retrive many pending transactions given a list of short ids or hashes.
+    """
+
+    ids = json.loads(request.get_data().decode())
+    return jsonify([t.to_dict() for t in blockchain.current_transactions.get_many(ids)]), 200
+
 @app.route("/transactions/length",methods=['GET'])
 def transactions_length():
     """
@@ -154,16 +225,24 @@ def transactions_length():
     }
     return jsonify(resp), 200
 
+@app.route("/transactions/cache",methods=['GET'])
+def transactions_cache():
+    """
+    GET request to view the size and hit/miss counters of the verified transactions cache.
+    """
+
+    return jsonify(blockchain.verified_transactions.stats()), 200
+
 @app.route("/transaction/<hash>")
 def get_transaction(hash):
     """
     GET request to retrive a single transaction given a hash.
     """
 
-    tra = [i for i in blockchain.current_transactions if i['hash']==hash]
-    if len(tra)==1:
-        return jsonify(tra[0]), 200
-    elif len(tra)==0:
+    tra = blockchain.current_transactions.get(hash)
+    if tra is not None:
+        return jsonify(tra.to_dict()), 200
+    else:
         
         # Create response
         resp = {
@@ -171,14 +250,24 @@ def get_transaction(hash):
         }
         
         return jsonify(resp), 200
+
+@app.route("/transaction/<hash>/proof",methods=['GET'])
+def get_transaction_proof(hash):
+    """
+    GET request to retrive the Merkle inclusion proof of a confirmed transaction with the header of its block.
+    """
+
+    proof = blockchain.get_transaction_proof(hash)
+    if proof:
+        return jsonify(dict(proof, transaction=proof['transaction'].to_dict())), 200
     else:
-        
+
         # Create response
         resp = {
-            "error":"Error, multiple transactions found!",
+            "error":"No proof for transaction with hash: "+hash,
         }
 
-        return jsonify(resp), 200
+        return jsonify(resp), 404
 
 @app.route("/transactions/resolve",methods=['GET'])
 def resolve_transactions():
@@ -198,6 +287,14 @@ def get_nodes():
 
     return jsonify(blockchain.nodes), 200
 
+@app.route("/nodes/stats",methods=['GET'])
+def nodes_stats():
+    """
+    GET request to view the requests, failures and latency of every node.
+    """
+
+    return jsonify(blockchain.broadcaster.stats()), 200
+
 @app.route("/nodes/resolve",methods=['GET'])
 def resolve_node():
     threading.Thread(target=blockchain.resolve_chains).start()
@@ -212,6 +309,8 @@ def add_node():
 
     node = request.get_data().decode()
 
+    if args.light:
+        return jsonify(blockchain.add_node(node)), 200
     if blockchain.is_valid_node(node):
         blockchain.add_node(node)
         return jsonify(True), 200
@@ -222,32 +321,138 @@ def discover_nodes():
     threading.Thread(target=blockchain.discover_nodes).start()
     return "Discovery started", 201
 
+def stream_chain(headers_only=False):
+    """
+    Streams the blocks (or only their headers) of the chain, see full_chain for the arguments.
+    """
+
+    chain = blockchain.chain
+    start = request.args.get("cursor", request.args.get("start", 0, type=int), type=int)
+    stop = min(request.args.get("stop", len(chain), type=int), len(chain))
+    limit = request.args.get("limit", None, type=int)
+
+    headers = {}
+    if limit is not None and start+limit < stop:
+        stop = start+limit
+        headers["X-Next-Cursor"] = str(stop)
+
+    accept = request.headers.get("Accept", "")
+    binary = not headers_only and (request.args.get("format")=="binary" or codec_utils.MIMETYPE in accept)
+    ndjson = request.args.get("format")=="ndjson" or "application/x-ndjson" in accept
+    if binary:
+        body = iter_chain_binary(chain, start, max(start, stop))
+        mimetype = codec_utils.MIMETYPE
+    else:
+        body = iter_chain_json(chain, start, max(start, stop), ndjson, headers_only)
+        mimetype = "application/x-ndjson" if ndjson else "application/json"
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        body = gzip_stream(body)
+        headers["Content-Encoding"] = "gzip"
+
+    return Response(stream_with_context(body), mimetype=mimetype, headers=headers), 200
+
 @app.route("/chain",methods=['GET'])
 def full_chain():
     """
-    GET request to view full chain.
+    GET request to view the chain, streamed block by block.
+    Optional arguments: start and stop (excluded) block numbers, limit and cursor to get it by pages
+    (the X-Next-Cursor header has the cursor of the next page) and format=ndjson for newline delimited blocks.
+    Length prefixed binary records are sent instead if the Accept header has application/x-bchain.
+    The response is gzipped if the client accepts it.
+    """
+
+    return stream_chain()
+
+@app.route("/chain/headers",methods=['GET'])
+def chain_headers():
+    """
+    GET request to view the block headers (blocks without tokens), same arguments as /chain (json only).
     """
 
-    return jsonify(blockchain.chain), 200
+    return stream_chain(headers_only=True)
+
+@app.route("/chain/locate",methods=['POST'])
+def locate_fork():
+    """
+    POST request with a block locator (list of block hashes from the tip back), returns the number of blocks in common.
+    """
+
+    locator = json.loads(request.get_data().decode())
+
+    # Create response
+    resp = {
+        "fork": blockchain.find_fork(locator),
+        "length": len(blockchain.chain),
+    }
+    return jsonify(resp), 200
 
 @app.route("/chain/add",methods=['POST'])
 def add_block():
 
-    b = json.loads(request.get_data().decode())
-    if blockchain.is_valid_next_block(blockchain.last_block, b):
-        blockchain.update_chain(b)
-        return jsonify(b['hash']), 201
-    elif request.headers.get("port",None) is not None:
+    try:
+        b = Block.from_dict(read_body())
+    except ValueError:
+        return jsonify("invalid"), 401
+    status = blockchain.receive_block(b)
+    if status in ("added", "reorg"):
+        return jsonify(b.hash), 201
+    elif status in ("known", "side"):
+        return jsonify(status), 202
+    elif status == "orphan" and request.headers.get("port",None) is not None:
+        # We are missing its parents, sync with the sender from the fork point
         node = "http://"+request.remote_addr+":"+str(request.headers.get("port"))
         updated = blockchain.resolve_chain(node)
         if updated:
             return jsonify("Chain updated"), 201
         else:
             try:
-                r = requests.post(node,headers={"port": str(args.port)},data=json.dumps(blockchain.last_block))
+                r = requests.post(node,headers={"port": str(args.port)},data=json.dumps(blockchain.last_block.to_dict()))
             except:
                 pass
             return jsonify("Chain not updated"), 401
+    else:
+        return jsonify(status), 401
+
+@app.route("/chain/transaction/<hash>",methods=['GET'])
+def get_confirmed_transaction(hash):
+    """
+    GET request to retrive a confirmed transaction given a hash, with its block and position.
+    """
+
+    tra = blockchain.get_confirmed_transaction(hash)
+    if tra is not None:
+        return jsonify(dict(tra, transaction=tra['transaction'].to_dict())), 200
+    else:
+
+        # Create response
+        resp = {
+            "error":"No confirmed transaction found with hash: "+hash
+        }
+
+        return jsonify(resp), 404
+
+@app.route("/address/<address>/transactions",methods=['GET'])
+def address_transactions(address):
+    """
+    GET request to view the confirmed transactions sent or received by an address.
+    Optional argument: start block number.
+    """
+
+    start = request.args.get("start", 0, type=int)
+    txs = blockchain.tx_index.address_transactions(address, start)
+    return jsonify([{"hash": h, "block_n": n, "position": pos} for h, n, pos in txs]), 200
+
+@app.route("/chain/validate",methods=['GET'])
+def validate_chain():
+    """
+    GET request to revalidate the full chain from the genesis block and rebuild the state.
+    """
+
+    # Create response
+    resp = {
+        "valid": blockchain.validate_chain(),
+    }
+    return jsonify(resp), 200
 
 @app.route("/chain/length",methods=['GET'])
 def chain_length():
@@ -267,7 +472,7 @@ def last_block():
     GET request to view the last block on node's chain.
     """
 
-    return jsonify(blockchain.last_block), 200
+    return jsonify(blockchain.last_block.to_dict()), 200
 
 @app.route("/working",methods=['GET'])
 def working():
@@ -284,10 +489,7 @@ def state():
     GET request to view the current state in main chain.
     """
     
-    # Get state
-    state = blockchain.is_valid_chain()
-    
-    return jsonify(state), 200
+    return jsonify(blockchain.state), 200
 
 @app.route("/state/all",methods=['GET'])
 def state_all():
@@ -295,14 +497,53 @@ def state_all():
     GET request to view the current state adding the pending transactions.
     """
 
-    # Get state
-    state = blockchain.is_valid_chain()
-    
     # Update with pending transactions
-    state = blockchain.update_state(state, blockchain.current_transactions)
+    state = blockchain.update_state(blockchain.state, blockchain.current_transactions)
     
     return jsonify(state), 200
 
+@app.route("/light/sync",methods=['GET'])
+def light_sync():
+    """
+    GET request to sync the headers and the watched addresses with the nodes (light node).
+    """
+
+    if not blockchain.resolving_chains:
+        threading.Thread(target=blockchain.resolve_chains).start()
+        return "sync started", 201
+    return "sync already running", 200
+
+@app.route("/light/watch",methods=['POST'])
+def light_watch():
+    """
+    POST request with an address to watch (light node).
+    """
+
+    address = request.get_data().decode()
+    return jsonify(blockchain.watch(address)), 200
+
+@app.route("/light/address/<address>",methods=['GET'])
+def light_address(address):
+    """
+    GET request to view the balance and the proven transactions of a watched address (light node).
+    """
+
+    if address not in blockchain.watched:
+        return jsonify({"error":"Address not watched: "+address}), 404
+    return jsonify(blockchain.balance(address)), 200
+
+@app.route("/light/headers",methods=['GET'])
+def light_headers():
+    """
+    GET request to view the number of headers and the last one (light node).
+    """
+
+    resp = {
+        "length": len(blockchain.headers),
+        "last": blockchain.headers[-1] if blockchain.headers else None,
+    }
+    return jsonify(resp), 200
+
 @app.route("/uid",methods=['GET'])
 def get_uid():
     return node_identifier, 200
@@ -311,6 +552,23 @@ def get_uid():
 def mining():
     return jsonify(blockchain.mining), 200
 
+@app.route("/metrics",methods=['GET'])
+def metrics():
+    """
+    GET request to view the mining metrics: hashrate, nonces, time to solution, interrupted attempts,
+    stale work, template build time and delay from finding a block to a node accepting it.
+    """
+
+    return jsonify(blockchain.metrics.stats()), 200
+
+@app.route("/mining/template",methods=['GET'])
+def mining_template():
+    """
+    GET request to view how full the last block template was and the transactions it skipped.
+    """
+
+    return jsonify(blockchain.template_stats), 200
+
 """
 This section will be a test gui to simplify debugging
 """
@@ -347,4 +605,6 @@ def add_node_gui():
     return render_template("add_node.html")
 
 if __name__=="__main__":
+    if args.light:
+        threading.Thread(target=blockchain.resolve_chains, daemon=True).start()
     app.run(host='0.0.0.0',port=args.port, debug=True)
@@ -0,0 +1,258 @@
+from pathlib import Path
+import json, os, threading
+import config, codec_utils
+
+class BlockStore:
+    """
+    Append-only block storage. Blocks are written to rolling segment files as json lines
+    (blk00000.jsonl, blk00001.jsonl...) or binary records (blk00000.bin...), see config.store_encoding,
+    and an index file keeps, for every height, the segment, offset and length of the block and its hash.
+    A segment holds a single encoding, a new one is started when the encoding changes.
+    """
+
+    SEGMENT_NAMES = {"json": "blk{:05d}.jsonl", "binary": "blk{:05d}.bin"}
+    INDEX_NAME = "index.jsonl"
+
+    def __init__(self, path=None, segment_size=None):
+        self.path = Path(config.blocks_dir if path is None else path)
+        self.segment_size = config.segment_size if segment_size is None else segment_size
+        self.lock = threading.RLock()
+
+        # height -> (segment, offset, length, hash, end of its line in the index file)
+        self.entries = []
+        # hash -> height
+        self.heights = {}
+        # segment -> path of the existing segment files
+        self.segments = {}
+
+        if not self.path.exists():
+            self.path.mkdir(parents=True)
+        self.rename_binary_segments()
+        self.load_index()
+
+    def segment_path(self, segment):
+        """
+        :param segment: <int> Segment number.
+        :return: <pathlib.Path> Path of the segment file, a new segment is named after config.store_encoding.
+        """
+        path = self.segments.get(segment)
+        if path is None:
+            for name in self.SEGMENT_NAMES.values():
+                if (self.path/name.format(segment)).exists():
+                    path = self.segments[segment] = self.path/name.format(segment)
+                    return path
+            return self.path/self.SEGMENT_NAMES[config.store_encoding].format(segment)
+        return path
+
+    def rename_binary_segments(self):
+        """
+        Gives the .bin extension to the binary segments written with the .jsonl one (older stores).
+        """
+        for p in self.path.glob("blk*.jsonl"):
+            with p.open("rb") as f:
+                first = f.read(1)
+            if first == codec_utils.MAGIC:
+                p.rename(p.with_suffix(".bin"))
+
+    def remove_segment(self, segment):
+        """
+        :param segment: <int> Segment number.
+        :return: <bool> False if the segment didn't exist.
+        """
+        sp = self.segment_path(segment)
+        self.segments.pop(segment, None)
+        if not sp.exists():
+            return False
+        os.remove(sp)
+        return True
+
+    @property
+    def index_path(self):
+        return self.path/self.INDEX_NAME
+
+    def load_index(self):
+        """
+        Reads the index file, dropping the entries whose block is not fully written
+        and the data written after the last indexed block (interrupted append).
+        """
+
+        if self.index_path.exists():
+            with self.index_path.open("rb") as f:
+                iend = 0
+                for line in f:
+                    try:
+                        height, segment, offset, length, h = json.loads(line)
+                    except ValueError:
+                        break
+                    if height != len(self.entries) or not line.endswith(b"\n"):
+                        break
+                    sp = self.segment_path(segment)
+                    if not sp.exists() or sp.stat().st_size < offset+length:
+                        break
+                    iend += len(line)
+                    self.entries.append((segment, offset, length, h, iend))
+                    self.heights[h] = height
+            self.truncate(len(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, h):
+        return h in self.heights
+
+    def hash_at(self, height):
+        """
+        :param height: <int> Block number.
+        :return: <str> Hash of the stored block at height.
+        """
+        return self.entries[height][3]
+
+    def height_of(self, h):
+        """
+        :param h: <str> Block hash.
+        :return: <int> Height of the block or <None> if it's not stored.
+        """
+        return self.heights.get(h)
+
+    def append(self, block):
+        """
+        Appends a block at the end of the store.
+
+        :param block: <Block> Block to append, its block_n must be the current length of the store.
+        """
+
+        with self.lock:
+            if block.block_n != len(self.entries):
+                raise ValueError("Block {} can't be appended at height {}".format(block.block_n, len(self.entries)))
+            data = self.encode(block)
+
+            # Pick the segment, roll to a new one if the last one is full or has another encoding
+            if self.entries:
+                segment, offset, length = self.entries[-1][:3]
+                offset += length
+                name = self.SEGMENT_NAMES[config.store_encoding].format(segment)
+                if offset+len(data) > self.segment_size or self.segment_path(segment).name != name:
+                    segment, offset = segment+1, 0
+            else:
+                segment, offset = 0, 0
+
+            sp = self.segment_path(segment)
+            with sp.open("ab") as f:
+                f.write(data)
+            self.segments[segment] = sp
+
+            line = (json.dumps([block.block_n, segment, offset, len(data), block.hash])+"\n").encode()
+            iend = self.index_end()+len(line)
+            with self.index_path.open("ab") as f:
+                f.write(line)
+
+            self.entries.append((segment, offset, len(data), block.hash, iend))
+            self.heights[block.hash] = block.block_n
+
+    @staticmethod
+    def encode(block):
+        """
+        :param block: <Block> Block.
+        :return: <bytes> Block record in config.store_encoding.
+        """
+        if config.store_encoding == "binary":
+            return codec_utils.encode(block.to_dict())
+        return (json.dumps(block.to_dict(), sort_keys=True)+"\n").encode()
+
+    def index_end(self):
+        """
+        :return: <int> Size of the index file covered by the entries.
+        """
+        return self.entries[-1][4] if self.entries else 0
+
+    def truncate(self, height):
+        """
+        Removes every block from height (included) to the end.
+
+        :param height: <int> New length of the store.
+        """
+
+        with self.lock:
+            for e in self.entries[height:]:
+                del self.heights[e[3]]
+            del self.entries[height:]
+
+            # Cut the last kept segment and remove the following ones
+            n = 0
+            if self.entries:
+                segment, offset, length = self.entries[-1][:3]
+                end = offset+length
+                sp = self.segment_path(segment)
+                if sp.exists() and sp.stat().st_size > end:
+                    with sp.open("r+b") as f:
+                        f.truncate(end)
+                n = segment+1
+            while self.remove_segment(n):
+                n += 1
+
+            if self.index_path.exists() and self.index_path.stat().st_size > self.index_end():
+                with self.index_path.open("r+b") as f:
+                    f.truncate(self.index_end())
+
+    def get(self, height):
+        """
+        Reads a single block.
+
+        :param height: <int> Block number, negative values count from the end.
+        :return: <dict> Block (json shape).
+        """
+        segment, offset, length = self.entries[height][:3]
+        with self.segment_path(segment).open("rb") as f:
+            f.seek(offset)
+            return codec_utils.loads(f.read(length))
+
+    def get_by_hash(self, h):
+        """
+        Reads a single block given its hash.
+
+        :param h: <str> Block hash.
+        :return: <dict> Block (json shape) or <None> if it's not stored.
+        """
+        height = self.heights.get(h)
+        return None if height is None else self.get(height)
+
+    def iter_blocks(self, start=0, stop=None):
+        """
+        Reads the blocks in [start, stop) one by one, each segment is opened once.
+
+        :param start: <int> (Optional) First height, default to 0.
+        :param stop: <int> (Optional) Height where to stop (excluded), default to the store length.
+        :return: <generator> Blocks (json shape).
+        """
+
+        entries = self.entries[start:stop]
+        f, current = None, None
+        try:
+            for segment, offset, length in (e[:3] for e in entries):
+                if segment != current:
+                    if f is not None:
+                        f.close()
+                    f, current = self.segment_path(segment).open("rb"), segment
+                f.seek(offset)
+                yield codec_utils.loads(f.read(length))
+        finally:
+            if f is not None:
+                f.close()
+
+    def sync(self, chain):
+        """
+        Makes the store equal to a chain: keeps the common prefix, truncates the blocks
+        that differ (reorg) and appends the new ones.
+
+        :param chain: <list> Chain to store.
+        """
+
+        with self.lock:
+            # Walk back from the end until the stored and given hashes match
+            i = min(len(self.entries), len(chain))
+            while i > 0 and self.entries[i-1][3] != chain[i-1].hash:
+                i -= 1
+            if i < len(self.entries):
+                self.truncate(i)
+            for block in chain[i:]:
+                self.append(block)
@@ -0,0 +1,81 @@
+import itertools
+from types import SimpleNamespace
+from blocktemplate import BlockTemplate
+from transaction_utils import Transaction
+
+_n = itertools.count()
+
+def txn(sender, recipient, amount):
+    # A different timestamp gives every transaction its own hash
+    return Transaction.sealed(sender=sender, recipient=recipient, amount=amount, timestamp=str(next(_n)),
+                              public_key="ab"*32, signature="cd"*32)
+
+class Counter:
+    """
+    is_valid for the template: the sender funds must cover the amount. It counts the checks.
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, state, t):
+        self.calls += 1
+        return state.get(t.sender, 0) >= t.amount
+
+def make_template(state, max_bytes=10**6, max_transactions=100, is_valid=None):
+    parent = SimpleNamespace(block_n=0, hash="00"*32, pow=9)
+    return BlockTemplate(parent, 1, state, is_valid or Counter(), txn("0", "miner", 1.0), max_bytes, max_transactions)
+
+def test_picks_valid_transactions_in_pool_order():
+    a, b, c = txn("alice", "bob", 2.0), txn("alice", "bob", 2.0), txn("alice", "bob", 2.0)
+    t = make_template({'alice': 5.0}).fill([a, b, c], "age")
+    assert t.picked == [a, b]
+    assert t.transactions[-1] == t.reward
+    assert t.skipped == {'size': 0, 'conflict': 0, 'invalid': 1}
+    assert t.state['alice'] == 1.0 and t.state['bob'] == 4.0
+
+def test_amount_policy_picks_the_largest_first():
+    small, large = txn("alice", "bob", 1.0), txn("alice", "bob", 3.0)
+    t = make_template({'alice': 3.0}).fill([small, large], "amount")
+    assert t.picked == [large]
+
+def test_transaction_spending_a_later_one_is_picked():
+    spend = txn("bob", "carol", 1.0)
+    fund = txn("alice", "bob", 1.0)
+    t = make_template({'alice': 1.0}).fill([spend, fund], "age")
+    assert t.picked == [fund, spend]
+    assert t.skipped['invalid'] == 0
+
+def test_dependent_transactions_are_not_retried_for_every_pick():
+    # Each transaction is funded by the next one in pool order, plus many unrelated ones
+    n = 200
+    chain = [txn("w{}".format(i+1), "w{}".format(i), 1.0) for i in range(n)]
+    others = [txn("alice", "bob", 0.001) for _ in range(n)]
+    counter = Counter()
+    t = make_template({'w{}'.format(n): 1.0, 'alice': 1.0}, max_transactions=10*n, is_valid=counter).fill(chain+others, "age")
+    assert len(t.picked) == 2*n
+    assert counter.calls <= 3*n
+
+def test_budgets():
+    txs = [txn("alice", "bob", 1.0) for _ in range(5)]
+    t = make_template({'alice': 10.0}, max_transactions=3).fill(txs, "age")
+    assert len(t.transactions) == 3 and t.is_full()
+    assert t.skipped['size'] == 3
+    t = make_template({'alice': 10.0}).fill([], "age")
+    t = make_template({'alice': 10.0}, max_bytes=t.reward.size+2*txs[0].size).fill(txs, "age")
+    assert t.picked == txs[:2]
+    assert t.stats()['bytes'] <= t.max_bytes
+
+def test_duplicates_and_rewards_conflict():
+    a = txn("alice", "bob", 1.0)
+    t = make_template({'alice': 10.0}).fill([a, a, txn("0", "bob", 1.0)], "age")
+    assert t.picked == [a]
+    assert t.skipped['conflict'] == 1
+
+def test_push_counts_a_skip_once():
+    t = make_template({'alice': 1.0}).fill([], "age")
+    a, b = txn("alice", "bob", 1.0), txn("alice", "bob", 1.0)
+    assert t.push(a) == 'added'
+    assert t.push(b) == 'invalid'
+    assert t.push(b) == 'invalid'
+    assert t.skipped['invalid'] == 1
@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+from blocktree import BlockTree
+
+def block(n, h, previous_hash):
+    return SimpleNamespace(block_n=n, hash=h, previous_hash=previous_hash)
+
+# Main chain m0 <- m1 <- m2, side branch m1 <- s2 <- s3 <- s4
+MAIN = {'m0': 0, 'm1': 1, 'm2': 2}
+S2, S3, S4 = block(2, 's2', 'm1'), block(3, 's3', 's2'), block(4, 's4', 's3')
+
+def make_tree(max_blocks=10):
+    tree = BlockTree(max_blocks=max_blocks, max_orphans=10)
+    for b in (S2, S3, S4):
+        tree.add(b)
+    return tree
+
+def test_branch_walks_back_to_the_main_chain():
+    fork, branch = make_tree().branch(S4, MAIN.get)
+    assert fork == 2
+    assert [b.hash for b in branch] == ['s2', 's3', 's4']
+
+def test_branch_of_a_block_on_the_main_chain():
+    fork, branch = make_tree().branch(block(3, 'x3', 'm2'), MAIN.get)
+    assert fork == 3 and [b.hash for b in branch] == ['x3']
+
+def test_branch_is_none_when_an_ancestor_was_evicted():
+    tree = make_tree(max_blocks=2)
+    assert 's2' not in tree
+    assert tree.branch(S4, MAIN.get) is None
+
+def test_orphan_branch_waits_for_the_missing_ancestor():
+    tree = make_tree(max_blocks=2)
+    tree.orphan_branch(S4)
+    assert len(tree) == 0
+    assert 's3' in tree and 's4' in tree
+    assert [b.hash for b in tree.pop_orphans('s2')] == ['s3']
+    assert [b.hash for b in tree.pop_orphans('s3')] == ['s4']
+
+def test_prune_drops_deep_blocks():
+    tree = make_tree()
+    tree.add_orphan(block(1, 'o1', 'unknown'))
+    tree.prune(3)
+    assert 's2' not in tree and 'o1' not in tree
+    assert 's3' in tree and 's4' in tree
+    assert tree.pop_orphans('unknown') == []
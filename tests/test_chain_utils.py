@@ -0,0 +1,62 @@
+import json
+import pytest
+import config
+import chain_utils
+from chain_utils import Block, load_chain, save_chain, get_store
+
+GENESIS = {
+    'block_n': 0,
+    'timestamp': '2024-01-01T00:00:00',
+    'token_n': 1,
+    'tokens': [{
+        'sender': '0',
+        'recipient': '1BhmABwUqyhXA6dhuK8H1wjbfjzeF2Y137',
+        'amount': 1.0,
+        'timestamp': '2024-01-01T00:00:00',
+        'public_key': 'ab'*64,
+        'signature': 'cd'*64,
+        'hash': 'ef'*32,
+    }],
+    'miner': '1BhmABwUqyhXA6dhuK8H1wjbfjzeF2Y137',
+    'previous_hash': '0',
+    'pow': 9,
+}
+
+@pytest.fixture(autouse=True)
+def store_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "blocks_dir", str(tmp_path/"blocks"))
+    monkeypatch.setattr(config, "chain_path", str(tmp_path/"chain.json"))
+    monkeypatch.setattr(chain_utils, "_store", None)
+    return tmp_path
+
+def test_legacy_chain_json_is_imported(store_dir):
+    (store_dir/"chain.json").write_text(json.dumps([dict(GENESIS, hash='aa'*32)]))
+    chain = load_chain()
+    assert len(chain) == 1
+    assert isinstance(chain[0], Block)
+    assert chain[0].hash == 'aa'*32
+    assert len(get_store()) == 1
+
+def test_saved_chain_is_loaded_back():
+    chain = [Block.sealed(**GENESIS)]
+    save_chain(chain)
+    loaded = load_chain()
+    assert [b.hash for b in loaded] == [chain[0].hash]
+    assert loaded[0].tokens[0].to_dict() == GENESIS['tokens'][0]
+
+def test_stored_chain_reads_and_replaces_blocks():
+    blocks = [Block.sealed(**dict(GENESIS, block_n=n, pow=n)) for n in range(5)]
+    save_chain(blocks)
+    chain = load_chain()
+    assert len(chain) == 5
+    assert len(chain.cache) == 0
+    assert chain[-1].hash == blocks[4].hash
+    assert [b.hash for b in chain[1:3]] == [blocks[1].hash, blocks[2].hash]
+    assert [b.hash for b in chain] == [b.hash for b in blocks]
+    with pytest.raises(IndexError):
+        chain[5]
+
+    fork = [Block.sealed(**dict(GENESIS, block_n=n, pow=10+n)) for n in (3, 4, 5)]
+    chain.replace(3, fork)
+    assert [b.hash for b in chain] == [b.hash for b in blocks[:3]+fork]
+    assert [b.hash for b in load_chain()] == [b.hash for b in blocks[:3]+fork]
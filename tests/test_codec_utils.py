@@ -0,0 +1,75 @@
+import io
+import pytest
+import codec_utils
+
+BLOCK = {
+    'block_n': 12,
+    'timestamp': '2024-01-01T10:20:30.123456',
+    'token_n': 1,
+    'tokens': [{
+        'sender': '1BhmABwUqyhXA6dhuK8H1wjbfjzeF2Y137',
+        'recipient': '0',
+        'amount': 1.5,
+        'timestamp': '2024-01-01T10:20:00',
+        'public_key': 'ab'*64,
+        'signature': 'cd'*64,
+        'hash': 'ef'*32,
+    }],
+    'miner': '1BhmABwUqyhXA6dhuK8H1wjbfjzeF2Y137',
+    'previous_hash': '01'*32,
+    'pow': 123456789,
+    'merkle_root': '02'*32,
+    'target': 2**240,
+    'hash': '03'*32,
+}
+
+@pytest.mark.parametrize("value", [
+    BLOCK,
+    {'unknown': [None, True, False, -1, 0, 2**70, -2.25, "text", "", []]},
+    # Strings that only look like hex, base58 or timestamps are kept as they are
+    {'a': "ABCD", 'b': "abc", 'c': "2024-01-01T10:20:30+00:00", 'd': "2024-01-01 10:20:30", 'e': "1"*30},
+])
+def test_round_trip(value):
+    assert codec_utils.decode(codec_utils.encode(value)) == value
+
+def test_encoding_is_canonical():
+    reordered = dict(reversed(list(BLOCK.items())))
+    assert codec_utils.encode(reordered) == codec_utils.encode(BLOCK)
+
+def test_loads_reads_json_and_binary():
+    assert codec_utils.loads(codec_utils.encode(BLOCK)) == BLOCK
+    assert codec_utils.loads(b'{"a": 1}') == {'a': 1}
+
+def test_frames():
+    values = [BLOCK, {'a': 1}, []]
+    stream = io.BytesIO(b"".join(codec_utils.frame(v) for v in values))
+    assert list(codec_utils.iter_frames(stream.read)) == values
+
+def test_truncated_records_raise_value_error():
+    data = codec_utils.encode(BLOCK)
+    for n in range(len(data)):
+        with pytest.raises(ValueError):
+            codec_utils.decode(data[:n])
+
+def test_corrupted_records_raise_value_error():
+    data = codec_utils.encode(BLOCK)
+    for i in range(2, len(data)):
+        corrupted = bytearray(data)
+        corrupted[i] ^= 0xff
+        # Either it's rejected or it decodes to another value, never any other error
+        try:
+            decoded = codec_utils.decode(bytes(corrupted))
+        except ValueError:
+            continue
+        assert decoded != BLOCK
+
+def test_deeply_nested_records_raise_value_error():
+    data = codec_utils.MAGIC+bytes([codec_utils.VERSION])+bytes([codec_utils.T_LIST, 1])*100000
+    with pytest.raises(ValueError):
+        codec_utils.decode(data)
+
+def test_truncated_streams_raise_value_error():
+    data = codec_utils.frame(BLOCK)
+    for n in range(1, len(data)):
+        with pytest.raises(ValueError):
+            list(codec_utils.iter_frames(io.BytesIO(data[:n]).read))
@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+from mempool import Mempool
+
+def txn(h, sender, amount):
+    return SimpleNamespace(hash=h*64, sender=sender, amount=amount)
+
+def test_reservations_follow_the_pending_transactions():
+    pool = Mempool()
+    assert pool.add(txn("a", "alice", 1.5))
+    assert pool.add(txn("b", "alice", 2.0))
+    assert pool.add(txn("c", "bob", 1.0))
+    assert pool.reserved_by("alice") == 3.5
+    assert pool.reserved_by("bob") == 1.0
+    pool.remove("a"*64)
+    assert pool.reserved_by("alice") == 2.0
+    pool.remove("b"*64)
+    assert pool.reserved_by("alice") == 0
+    assert pool.sender_transactions("alice") == []
+
+def test_duplicates_are_not_reserved_twice():
+    pool = Mempool()
+    t = txn("a", "alice", 1.0)
+    assert pool.add(t)
+    assert not pool.add(t)
+    assert pool.reserved_by("alice") == 1.0
+
+def test_rewards_reserve_nothing():
+    pool = Mempool()
+    pool.add(txn("a", "0", 1.0))
+    assert pool.reserved_by("0") == 0
+
+def test_eviction_releases_the_reservation():
+    pool = Mempool(capacity=2)
+    pool.add(txn("a", "alice", 1.0))
+    pool.add(txn("b", "bob", 1.0))
+    pool.add(txn("c", "bob", 2.0))
+    assert "a"*64 not in pool
+    assert pool.reserved_by("alice") == 0
+    assert pool.reserved_by("bob") == 3.0
+    assert pool.hashes() == ["b"*64, "c"*64]
+
+def test_short_ids():
+    pool = Mempool()
+    pool.add(txn("a", "alice", 1.0))
+    assert pool.has_short_id("a"*16)
+    assert [t.hash for t in pool.get_many(["a"*16, "f"*16])] == ["a"*64]
@@ -0,0 +1,91 @@
+import datetime
+import pytest
+import config
+from pow_utils import (initial_target, max_target, next_target, is_valid_target, is_valid_timestamp,
+                       retarget, block_work, bits_to_target)
+
+START = datetime.datetime(2024, 1, 1)
+
+@pytest.fixture(autouse=True)
+def params(monkeypatch):
+    monkeypatch.setattr(config, "pow_bits", 16)
+    monkeypatch.setattr(config, "min_pow_bits", 8)
+    monkeypatch.setattr(config, "block_interval", 60)
+    monkeypatch.setattr(config, "retarget_interval", 10)
+    monkeypatch.setattr(config, "median_time_blocks", 11)
+    monkeypatch.setattr(config, "max_future_time", 7200)
+
+def make_chain(n, spacing, target=None):
+    """
+    :return: <list> Header dicts spaced by spacing seconds, all with the same target.
+    """
+    if target is None:
+        target = initial_target()
+    return [{'block_n': i, 'timestamp': (START+datetime.timedelta(seconds=i*spacing)).isoformat(), 'target': target}
+            for i in range(n)]
+
+def test_target_is_kept_inside_an_interval():
+    chain = make_chain(15, 1)
+    assert next_target(chain[-1], lambda h: chain[h]) == initial_target()
+
+def test_target_is_kept_when_blocks_are_on_time():
+    chain = make_chain(10, 60)
+    assert next_target(chain[-1], lambda h: chain[h]) == initial_target()
+
+def test_slow_blocks_make_the_target_easier():
+    chain = make_chain(10, 120)
+    assert next_target(chain[-1], lambda h: chain[h]) == initial_target()*2
+
+def test_retarget_is_clamped_to_4_times():
+    expected = config.block_interval*(config.retarget_interval-1)
+    assert retarget(initial_target(), 0) == initial_target()//4
+    assert retarget(initial_target(), expected*100) == initial_target()*4
+    assert retarget(max_target(), expected*4) == max_target()
+    assert retarget(1, 0) == 1
+
+def test_block_work():
+    assert block_work({'target': bits_to_target(10)}) == 2**10
+    assert block_work({'target': None}) == 2**config.pow_bits
+
+def test_is_valid_target():
+    chain = make_chain(10, 120)
+    ancestor = lambda h: chain[h]
+    block = {'block_n': 10, 'timestamp': START.isoformat(), 'target': initial_target()*2}
+    assert is_valid_target(chain[-1], block, ancestor)
+    assert not is_valid_target(chain[-1], dict(block, target=initial_target()), ancestor)
+    # Once a chain has targets they can't be left out
+    assert not is_valid_target(chain[-1], dict(block, target=None), ancestor)
+    assert is_valid_target(dict(chain[-1], target=None), dict(block, target=None), ancestor)
+    assert is_valid_target(None, chain[0], ancestor)
+    assert not is_valid_target(None, dict(chain[0], target=1), ancestor)
+
+def test_bad_ancestor_timestamp_is_an_invalid_target():
+    chain = make_chain(10, 60)
+    chain[0]['timestamp'] = "not a date"
+    block = {'block_n': 10, 'timestamp': START.isoformat(), 'target': initial_target()}
+    assert not is_valid_target(chain[-1], block, lambda h: chain[h])
+
+def test_timestamp_after_the_median():
+    chain = make_chain(20, 60)
+    ancestor = lambda h: chain[h]
+    now = START+datetime.timedelta(days=1)
+    median = datetime.datetime.fromisoformat(chain[14]['timestamp'])
+    block = {'block_n': 20, 'timestamp': (median+datetime.timedelta(seconds=1)).isoformat()}
+    assert is_valid_timestamp(chain[-1], block, ancestor, now)
+    assert not is_valid_timestamp(chain[-1], dict(block, timestamp=median.isoformat()), ancestor, now)
+
+def test_timestamp_in_the_future():
+    chain = make_chain(3, 60)
+    now = START+datetime.timedelta(minutes=5)
+    block = {'block_n': 3, 'timestamp': (now+datetime.timedelta(seconds=7200)).isoformat()}
+    assert is_valid_timestamp(chain[-1], block, lambda h: chain[h], now)
+    block['timestamp'] = (now+datetime.timedelta(seconds=7201)).isoformat()
+    assert not is_valid_timestamp(chain[-1], block, lambda h: chain[h], now)
+
+@pytest.mark.parametrize("timestamp", ["garbage", None, 12345, "2024-01-02T00:00:00+00:00"])
+def test_malformed_timestamps_are_invalid(timestamp):
+    chain = make_chain(3, 60)
+    now = START+datetime.timedelta(days=1)
+    block = {'block_n': 3, 'timestamp': timestamp}
+    assert not is_valid_timestamp(chain[-1], block, lambda h: chain[h], now)
+    assert not is_valid_timestamp(None, dict(block, block_n=0), None, now)
@@ -1,27 +1,68 @@
 from pathlib import Path
-import json, config
+from utils import Record
+from merkle_utils import merkle_leaf
+import codec_utils
+import json, sys, config
+
+class Transaction(Record):
+    """
+    Immutable transaction, its hash leaves out the 'hash' and 'signature' fields.
+    """
+
+    FIELDS = ('sender', 'recipient', 'amount', 'timestamp', 'public_key', 'signature', 'hash')
+    __slots__ = FIELDS+("_leaf", "_size")
+    HASH_EXCLUDE = ("hash", "signature")
+
+    def __init__(self, **fields):
+        # Addresses and public keys repeat a lot, keep a single copy of each string
+        for f in ('sender', 'recipient', 'public_key'):
+            if type(fields.get(f)) is str:
+                fields[f] = sys.intern(fields[f])
+        super().__init__(**fields)
+
+    @property
+    def leaf(self):
+        """
+        :return: <str> Merkle leaf of the transaction, it covers every field (signature included).
+        """
+        try:
+            return self._leaf
+        except AttributeError:
+            object.__setattr__(self, '_leaf', merkle_leaf(json.dumps(self.to_dict(), sort_keys=True).encode()))
+            return self._leaf
+
+    @property
+    def size(self):
+        """
+        :return: <int> Bytes of the binary record of the transaction, what it takes in a block.
+        """
+        try:
+            return self._size
+        except AttributeError:
+            object.__setattr__(self, '_size', len(codec_utils.encode(self.to_dict())))
+            return self._size
 
 def save_transactions(transactions):
     """
     Saves a given transaction list to config.transactions_path.
 
-    :param transactions: <list> List of transactions.
+    :param transactions: <list> List of <Transaction>.
     :return: <pathlib.Path> Path of the file saved.
     """
 
     p = Path(config.transactions_path)
-    p.write_text(json.dumps(transactions, sort_keys=True))
+    p.write_text(json.dumps([t.to_dict() for t in transactions], sort_keys=True))
     return p
 
 def load_transactions():
     """
     Loads a transaction list if the default file exists, otherwise returns a empty list.
 
-    :return: <list> List of transactions.
+    :return: <list> List of <Transaction>.
     """
-    
+
     p = Path(config.transactions_path)
     if p.exists():
-        return json.loads(p.read_text())
+        return [Transaction.from_dict(t) for t in json.loads(p.read_text())]
     else:
         return []
\ No newline at end of file
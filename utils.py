@@ -1,5 +1,5 @@
 from pathlib import Path
-import json
+import json, hashlib
 
 def load_data(path, default=[]):
     """
@@ -27,4 +27,103 @@ def save_data(data,path):
 
     p = Path(path)
     p.write_text(json.dumps(data, sort_keys=True))
-    return True
\ No newline at end of file
+    return True
+
+def hash_fields(data, exclude=()):
+    """
+    Hashes the canonical (sorted keys) json serialization of a dict leaving out some fields.
+
+    :param data: <dict> Data to hash.
+    :param exclude: <tuple> (Optional) Fields not included in the hash.
+    :return: <str> String representation of the sha-256 hash.
+    """
+
+    fields = {k: v for k, v in data.items() if k not in exclude}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+def _load_record(cls, values):
+    return cls(**dict(zip(cls.FIELDS, values)))
+
+class Record:
+    """
+    Immutable value with a fixed set of fields (FIELDS, kept in __slots__ by the subclasses).
+    Its json shape is {field: value}, only to_dict/from_dict convert from and to it.
+    OPTIONAL fields default to None and are left out of the json shape while they are None.
+    The hash (hash_fields of to_dict without the HASH_EXCLUDE fields) is computed
+    the first time it's needed and kept, since the content can't change afterwards.
+    """
+
+    __slots__ = ("_digest",)
+    FIELDS = ()
+    OPTIONAL = ()
+    HASH_EXCLUDE = ()
+
+    def __init__(self, **fields):
+        for f in self.FIELDS:
+            if f in fields:
+                object.__setattr__(self, f, fields.pop(f))
+            elif f in self.OPTIONAL:
+                object.__setattr__(self, f, None)
+            else:
+                raise ValueError("{} without field '{}'".format(type(self).__name__, f))
+        if fields:
+            raise ValueError("{} with unknown fields: {}".format(type(self).__name__, ", ".join(sorted(fields))))
+
+    def __setattr__(self, name, value):
+        raise TypeError("{} is immutable".format(type(self).__name__))
+
+    __delattr__ = __setattr__
+
+    def __reduce__(self):
+        # Pickle (worker processes) only the fields, the digest is computed again if needed
+        return (_load_record, (self.__class__, tuple(getattr(self, f) for f in self.FIELDS)))
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.to_dict())
+
+    def to_dict(self):
+        """
+        :return: <dict> Json shape of the value.
+        """
+        d = {f: getattr(self, f) for f in self.FIELDS}
+        for f in self.OPTIONAL:
+            if d[f] is None:
+                del d[f]
+        return d
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        :param data: <dict> Json shape of the value or an object of this class.
+        :return: Immutable object, data itself if it already was one.
+        """
+        if isinstance(data, cls):
+            return data
+        if not isinstance(data, dict):
+            raise ValueError("{} must be a dict".format(cls.__name__))
+        return cls(**data)
+
+    @classmethod
+    def sealed(cls, **fields):
+        """
+        Creates an immutable object adding its 'hash' field.
+
+        :return: Immutable object.
+        """
+        obj = cls(hash=None, **fields)
+        object.__setattr__(obj, 'hash', obj.digest)
+        return obj
+
+    @property
+    def digest(self):
+        """
+        :return: <str> Hash of the content, computed once.
+        """
+        try:
+            return self._digest
+        except AttributeError:
+            object.__setattr__(self, '_digest', self.compute_digest())
+            return self._digest
+
+    def compute_digest(self):
+        return hash_fields(self.to_dict(), self.HASH_EXCLUDE)